@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""
+Helpers for BGZF files. BGZF is the blocked gzip format used by samtools and
+htslib: a series of independent gzip members of at most 64 KB each, where
+every member records its own compressed size in a "BC" extra field. Any gzip
+reader can decompress a BGZF file, but because the block boundaries are known
+up front the blocks can also be decompressed independently, and with a .gzi
+index of where each block starts any part of the file can be read by
+decompressing only the blocks that hold it.
+"""
+__author__ = "boseHere"
+import bisect
+import collections
+import concurrent.futures
+import os
+import struct
+import zlib
+
+# Gzip header of a BGZF block up to and including the BSIZE field
+BGZF_HEADER = struct.Struct("<4BI2BH2BHH")
+
+# Largest amount of data put in one block. Kept below 64 KB so that even
+# incompressible data fits in a block after compression.
+MAX_BLOCK_DATA = 0xff00
+
+# Number of blocks compressed together by a worker
+WRITE_BATCH = 16
+
+# Empty block that marks the end of a BGZF file
+EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000"
+                          "000000")
+
+
+class BgzfError(Exception):
+    """Raised when a file is not valid BGZF."""
+
+
+def is_bgzf(filename):
+    """
+    This function tests whether a file starts with a BGZF block header.
+    :param: filename -- Name of the file to test.
+    :return: A boolean. True if the first block of the file is a BGZF block.
+    """
+    with open(filename, "rb") as infile:
+        return _block_size(infile.read(BGZF_HEADER.size)) is not None
+
+
+def _block_size(header):
+    """
+    This function reads the total size of a BGZF block from its header.
+    :param: header -- The first BGZF_HEADER.size bytes of the block.
+    :return: The size of the whole block in bytes, or None if the header is
+             not a BGZF header.
+    """
+    if len(header) < BGZF_HEADER.size:
+        return None
+    (id1, id2, method, flags, _, _, _, xlen, si1, si2, slen,
+     bsize) = BGZF_HEADER.unpack(header)
+    if (id1, id2, method) != (31, 139, 8) or not flags & 4:
+        return None
+    if (si1, si2, slen) != (66, 67, 2) or xlen != 6:
+        return None
+    return bsize + 1
+
+
+def read_blocks(infile):
+    """
+    This function splits a BGZF file into its compressed blocks without
+    decompressing them.
+    :param: infile -- A binary file object of a BGZF file.
+    :return: A generator of bytes objects, each one a whole BGZF block.
+    """
+    while True:
+        header = infile.read(BGZF_HEADER.size)
+        if not header:
+            break
+        size = _block_size(header)
+        if size is None:
+            raise BgzfError("Not a BGZF block at offset {}".format(
+                infile.tell() - len(header)))
+        block = header + infile.read(size - len(header))
+        if len(block) != size:
+            raise BgzfError("Truncated BGZF block")
+        yield block
+
+
+def inflate_block(block):
+    """
+    This function decompresses a single BGZF block.
+    :param: block -- A bytes object holding a whole BGZF block.
+    :return: The decompressed data of the block.
+    """
+    data = zlib.decompress(block[BGZF_HEADER.size:-8], -15)
+    crc, isize = struct.unpack("<II", block[-8:])
+    if len(data) != isize or zlib.crc32(data) != crc:
+        raise BgzfError("BGZF block failed its CRC check")
+    return data
+
+
+def inflate_blocks(blocks):
+    """
+    This function decompresses a list of BGZF blocks into one bytes object.
+    Meant to be run on a worker thread; zlib releases the GIL while it works.
+    :param: blocks -- A list of bytes objects, each one a whole BGZF block.
+    :return: The decompressed data of all the blocks, in order.
+    """
+    return b"".join([inflate_block(block) for block in blocks])
+
+
+def deflate_block(data, level):
+    """
+    This function compresses data into a single BGZF block.
+    :params: data -- A bytes object of at most MAX_BLOCK_DATA bytes.
+
+             level -- zlib compression level, 0-9.
+    :return: A bytes object holding the whole BGZF block.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = BGZF_HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2,
+                              BGZF_HEADER.size + len(cdata) + 8 - 1)
+    return header + cdata + struct.pack("<II", zlib.crc32(data), len(data))
+
+
+def deflate_blocks(data, level):
+    """
+    This function compresses data into as many BGZF blocks as needed. Meant
+    to be run on a worker thread; zlib releases the GIL while it works.
+    :params: data -- A bytes object to compress.
+
+             level -- zlib compression level, 0-9.
+    :return: A bytes object holding the BGZF blocks, in order.
+    """
+    return b"".join([deflate_block(data[i:i + MAX_BLOCK_DATA], level)
+                     for i in range(0, len(data), MAX_BLOCK_DATA)])
+
+
+class BgzfWriter:
+    """
+    A write-only binary file object that writes BGZF. Written data is cut into
+    blocks and, with more than one thread, compressed a batch of blocks per
+    thread. The blocks are always written in the order the data came in, so
+    the output is a normal gzip file that any gzip reader can decompress.
+    """
+
+    def __init__(self, filename, level=6, threads=1):
+        self.level = level
+        self.threads = threads
+        self._file = open(filename, "wb")
+        self._buffer = []
+        self._buffered = 0
+        self._pending = collections.deque()
+        if threads > 1:
+            self._pool = concurrent.futures.ThreadPoolExecutor(threads)
+        else:
+            self._pool = None
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= WRITE_BATCH * MAX_BLOCK_DATA:
+            self._compress(WRITE_BATCH * MAX_BLOCK_DATA)
+        return len(data)
+
+    def _compress(self, size):
+        data = b"".join(self._buffer)
+        # Only send whole blocks to be compressed; the rest waits for more data
+        end = len(data) - len(data) % size if size else len(data)
+        self._buffer = [data[end:]]
+        self._buffered = len(data) - end
+        data = data[:end]
+
+        if self._pool is None:
+            self._file.write(deflate_blocks(data, self.level))
+            return
+
+        self._pending.append(self._pool.submit(deflate_blocks, data,
+                                               self.level))
+        # Let the workers run a few batches ahead of the output file
+        while len(self._pending) > 2 * self.threads:
+            self._file.write(self._pending.popleft().result())
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._compress(0)
+        while self._pending:
+            self._file.write(self._pending.popleft().result())
+        if self._pool is not None:
+            self._pool.shutdown()
+        self._file.write(EOF_BLOCK)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def gzi_filename(filename):
+    """
+    This function gives the name of the .gzi index of a BGZF file.
+    :param: filename -- Name of the BGZF file.
+    :return: The name of the index file.
+    """
+    return filename + ".gzi"
+
+
+def build_gzi(filename):
+    """
+    This function reads through the block headers of a BGZF file and writes
+    its .gzi index, in the same format as bgzip -i: the number of entries,
+    then the compressed and uncompressed offset of the start of every block
+    after the first, all as little-endian 64-bit integers. Blocks are not
+    decompressed; their uncompressed sizes are read from their trailers.
+    :param: filename -- Name of the BGZF file.
+    :return: offsets -- A list of (compressed offset, uncompressed offset)
+                        tuples, one per block, starting with (0, 0).
+    """
+    offsets = []
+    coffset = uoffset = 0
+    with open(filename, "rb") as infile:
+        for block in read_blocks(infile):
+            offsets.append((coffset, uoffset))
+            coffset += len(block)
+            uoffset += struct.unpack("<I", block[-4:])[0]
+
+    with open(gzi_filename(filename), "wb") as gzi:
+        gzi.write(struct.pack("<Q", len(offsets) - 1))
+        for entry in offsets[1:]:
+            gzi.write(struct.pack("<QQ", *entry))
+    return offsets
+
+
+def read_gzi(filename):
+    """
+    This function reads the .gzi index of a BGZF file.
+    :param: filename -- Name of the BGZF file (not of the index).
+    :return: offsets -- A list of (compressed offset, uncompressed offset)
+                        tuples, one per block, starting with (0, 0).
+    """
+    with open(gzi_filename(filename), "rb") as gzi:
+        data = gzi.read()
+    count = struct.unpack("<Q", data[:8])[0]
+    offsets = [(0, 0)]
+    offsets.extend(struct.iter_unpack("<QQ", data[8:8 + 16 * count]))
+    return offsets
+
+
+def load_gzi(filename):
+    """
+    This function returns the block offsets of a BGZF file, building its .gzi
+    index first if it does not exist yet or is older than the file.
+    :param: filename -- Name of the BGZF file.
+    :return: offsets -- A list of (compressed offset, uncompressed offset)
+                        tuples, one per block, starting with (0, 0).
+    """
+    gzi = gzi_filename(filename)
+    if os.path.exists(gzi) and \
+            os.path.getmtime(gzi) >= os.path.getmtime(filename):
+        return read_gzi(filename)
+    return build_gzi(filename)
+
+
+class BgzfReader:
+    """
+    Random access to the decompressed data of a BGZF file through its .gzi
+    index. read_at() decompresses only the blocks that hold the requested
+    bytes. The last block read is kept, so nearby reads in a row do not
+    decompress it again.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        offsets = load_gzi(filename)
+        self._coffsets = [entry[0] for entry in offsets]
+        self._uoffsets = [entry[1] for entry in offsets]
+        self._file = open(filename, "rb")
+        self._cached = (None, b"")
+
+    def _block(self, i):
+        if self._cached[0] != i:
+            self._file.seek(self._coffsets[i])
+            self._cached = (i, inflate_block(next(read_blocks(self._file))))
+        return self._cached[1]
+
+    def read_at(self, offset, size):
+        """
+        This function reads decompressed data from anywhere in the file.
+        :params: offset -- Offset in the decompressed data to start at.
+
+                 size -- Number of bytes to read.
+        :return: A bytes object of at most size bytes. It is shorter if the
+                 end of the file is reached.
+        """
+        i = bisect.bisect_right(self._uoffsets, offset) - 1
+        chunks = []
+        while size > 0 and 0 <= i < len(self._uoffsets):
+            data = self._block(i)
+            start = offset - self._uoffsets[i]
+            chunk = data[start:start + size]
+            chunks.append(chunk)
+            offset += len(chunk)
+            size -= len(chunk)
+            i += 1
+        return b"".join(chunks)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -4,17 +4,40 @@
 Author: Maya Bose
 Date: 5/18/19
 Counts occurrences of matches between sequences in miRNA fasta file and  srna
-fastq file.
+fastq file. Given several srna fastq files, they are counted in parallel and a
+tab-separated miRNA x sample count matrix is printed. Options allow isomiRs:
+reads with mismatches, trimmed ends or extra bases at either end. Reads are
+collapsed to unique sequences before matching; the collapsed tables can be
+saved and given in place of the sRNA files in later runs.
 '''
 import argparse
 import gzip
+import multiprocessing
+import os
+import sys
+
+import fastq_io
+
+# Reference matcher and decompression threads of a worker process, set once
+# when the worker starts rather than sent along with every file
+WORKER = {}
+
+# Shortest trimmed miRNA that is still matched
+MIN_VARIANT_LENGTH = 16
+
+# Lookup value of variants that are equally close to more than one miRNA
+AMBIGUOUS = -1
 
 
 def main():
     d = get_args()
     mirna_dict = make_mirna_dict(d)
-    mirna_dict = count(mirna_dict, d)
-    output(mirna_dict)
+    if len(d['sRNA file']) > 1 or d['matrix']:
+        counts = count_samples(mirna_dict, d)
+        output_matrix(mirna_dict, d['sRNA file'], counts)
+    else:
+        mirna_dict = count(mirna_dict, d)
+        output(mirna_dict)
 
 
 def get_args():
@@ -22,12 +45,36 @@ def get_args():
                                                  "counts of those sequences in"
                                                  "a given miRNA reference "
                                                  "genome")
-    parser.add_argument('sRNA file', metavar='n', type=str, nargs=1,
-                        help='The sRNA seq filename')
+    parser.add_argument('sRNA file', metavar='n', type=str, nargs='+',
+                        help='The sRNA seq filename(s), or collapsed tables\
+                        (.tsv or .tsv.gz) saved with --collapsed_dir')
     parser.add_argument('miRNA file', metavar='s', type=str, nargs=1, help='The\
     miRNA reference filename')
+    parser.add_argument('--threads', type=int, default=1, help='Number of\
+    threads to decompress the sRNA file with')
+    parser.add_argument('--processes', type=int, default=1, help='Number of\
+    sRNA files to count at the same time')
+    parser.add_argument('--matrix', action='store_true', help='Print a count\
+    matrix even for a single sRNA file. Always used for several files')
+    parser.add_argument('--collapsed_dir', type=str, help='Directory to save\
+    the unique sequences and counts of each sRNA file to')
+    parser.add_argument('--mismatches', type=int, default=0, choices=[0, 1, 2],
+                        help='Number of mismatches allowed between a read and\
+    a miRNA')
+    parser.add_argument('--trim_5p', type=int, default=0, help='Number of\
+    bases a read may be missing from the 5\' end of a miRNA')
+    parser.add_argument('--trim_3p', type=int, default=0, help='Number of\
+    bases a read may be missing from the 3\' end of a miRNA')
+    parser.add_argument('--add_5p', type=int, default=0, help='Number of\
+    extra bases a read may have before the 5\' end of a miRNA')
+    parser.add_argument('--add_3p', type=int, default=0, help='Number of\
+    extra bases (templated or not) a read may have after the 3\' end of a\
+    miRNA')
     args = parser.parse_args()
     d = vars(args)
+    for option in ['trim_5p', 'trim_3p', 'add_5p', 'add_3p']:
+        if d[option] < 0:
+            parser.error('--{} must be 0 or more'.format(option))
     return d
 
 
@@ -47,25 +94,128 @@ def make_mirna_dict(d):
     return mirna_dict
 
 
+class Matcher:
+    '''
+    Finds the miRNA a read comes from. Exact matches, mismatches and trimmed
+    ends are all looked up in one dictionary of every allowed variant of every
+    miRNA, so matching a read costs a single lookup. A variant equally close to
+    two miRNAs is ambiguous and not counted. Extra bases at the ends of a read
+    are handled by looking up the read again with them removed, fewest bases
+    removed first; this only happens for reads that were not found at first.
+    '''
+
+    def __init__(self, mirna_dict, d):
+        self.rows = len(mirna_dict)
+        self.add_5p = d['add_5p']
+        self.add_3p = d['add_3p']
+
+        best = {}  # Lowest number of changes to each variant, and its miRNA
+        for row, seq in enumerate(mirna_dict):
+            for variant, cost in self.variants(seq, d):
+                key = variant.encode('utf-8')
+                old = best.get(key)
+                if old is None or cost < old[0]:
+                    best[key] = (cost, row)
+                elif cost == old[0] and old[1] != row:
+                    best[key] = (cost, AMBIGUOUS)
+
+        # Index the reference by the sequence as bytes, so reads never need to
+        # be decoded. Values are the position of the miRNA in mirna_dict.
+        self.lookup = {key: best[key][1] for key in best}
+
+    @staticmethod
+    def variants(seq, d):
+        # Every trimmed form of the miRNA, each with every allowed mismatch,
+        # along with the number of changes made
+        for trim_5p in range(d['trim_5p'] + 1):
+            for trim_3p in range(d['trim_3p'] + 1):
+                core = seq[trim_5p:len(seq) - trim_3p]
+                if len(core) >= MIN_VARIANT_LENGTH or core == seq:
+                    yield from mismatch_variants(core, d['mismatches'], 0,
+                                                 trim_5p + trim_3p)
+
+    def match_additions(self, seq):
+        # Look the read up again with extra bases removed from its ends
+        for extra in range(1, self.add_5p + self.add_3p + 1):
+            for add_5p in range(min(extra, self.add_5p) + 1):
+                add_3p = extra - add_5p
+                if add_3p <= self.add_3p:
+                    i = self.lookup.get(seq[add_5p:len(seq) - add_3p])
+                    if i is not None:
+                        return i
+        return None
+
+
+def mismatch_variants(seq, mismatches, start, cost):
+    # The sequence itself and every sequence with up to the given number of
+    # substitutions at or after position start
+    yield seq, cost
+    if mismatches:
+        for i in range(start, len(seq)):
+            for base in 'ACGU':
+                if base != seq[i]:
+                    yield from mismatch_variants(seq[:i] + base + seq[i + 1:],
+                                                 mismatches - 1, i + 1,
+                                                 cost + 1)
+
+
+def count_sample(filename, matcher, threads, collapsed_dir=None):
+    # Collapse the reads to unique sequences first, so each sequence is only
+    # matched once however many reads have it
+    collapsed = fastq_io.load_collapsed(filename, threads, collapsed_dir)
+    return count_collapsed(collapsed, matcher)
+
+
+def count_collapsed(collapsed, matcher):
+    # Count of each miRNA, in the order of mirna_dict, from a Counter of
+    # unique sequences and the number of reads with each
+    counts = [0] * matcher.rows
+    lookup = matcher.lookup
+    additions = matcher.add_5p or matcher.add_3p
+    for seq, n in collapsed.items():
+        seq = seq.replace(b'T', b'U')  # Change Thymine to Uracil
+
+        i = lookup.get(seq)
+        if i is None and additions:
+            i = matcher.match_additions(seq)
+        if i is not None and i != AMBIGUOUS:  # If the sequence matches the
+            counts[i] += n                    # reference, increase its count
+    return counts
+
+
 def count(mirna_dict, d):
-    with gzip.open(d['sRNA file'][0], 'r') as sfile:
-        i = 0
-        for line in sfile:
+    counts = count_sample(d['sRNA file'][0], Matcher(mirna_dict, d),
+                          d['threads'], d['collapsed_dir'])
+    for entry, n in zip(mirna_dict.values(), counts):
+        entry[1] += n
+    return mirna_dict
 
-            # Clean the lines
-            line = line.decode('utf-8')
-            line = line.rstrip('\n')
 
-            if i == 1:
-                seq = line.replace('T', 'U')  # Change Thymine to Uracil
+def init_worker(matcher, threads, collapsed_dir):
+    WORKER['matcher'] = matcher
+    WORKER['threads'] = threads
+    WORKER['collapsed_dir'] = collapsed_dir
 
-                if seq in mirna_dict:  # If the sequence is in the reference
-                                       # dictionary, increase its count
-                    mirna_dict[seq][1] += 1
-            i += 1
-            if i == 4:
-                i = 0
-    return mirna_dict
+
+def count_worker(filename):
+    return count_sample(filename, WORKER['matcher'], WORKER['threads'],
+                        WORKER['collapsed_dir'])
+
+
+def count_samples(mirna_dict, d):
+    # Count each sRNA file in its own worker process. The reference matcher is
+    # built once and handed to each worker when it starts.
+    files = d['sRNA file']
+    matcher = Matcher(mirna_dict, d)
+    processes = min(d['processes'], len(files))
+    if processes <= 1:
+        return [count_sample(file, matcher, d['threads'], d['collapsed_dir'])
+                for file in files]
+
+    with multiprocessing.Pool(processes, init_worker,
+                              (matcher, d['threads'],
+                               d['collapsed_dir'])) as pool:
+        return pool.map(count_worker, files, chunksize=1)
 
 
 def output(mirna_dict):
@@ -74,4 +224,15 @@ def output(mirna_dict):
                                         mirna_dict[seq][1]))
 
 
-main()
+def output_matrix(mirna_dict, files, counts):
+    # One row per miRNA and one column per sRNA file
+    rows = ["\t".join(["miRNA", "sequence"] +
+                      [os.path.basename(file) for file in files])]
+    for i, seq in enumerate(mirna_dict):
+        rows.append("\t".join([mirna_dict[seq][0][1:], seq] +
+                              [str(sample[i]) for sample in counts]))
+    sys.stdout.write("\n".join(rows) + "\n")
+
+
+if __name__ == '__main__':
+    main()
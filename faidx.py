@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Indexed access to fasta files. The index is written next to the fasta file in
+the same .fai format used by samtools faidx: one line per sequence giving its
+name, length, byte offset, bases per line and bytes per line. With the index a
+range of bases can be read by seeking straight to it, without reading the rest
+of the file. Fasta files compressed with BGZF are read through their .gzi
+block index, so that only the blocks holding the bases are decompressed.
+"""
+__author__ = "boseHere"
+import collections
+import gzip
+import mmap
+import os
+
+import bgzf
+
+# One line of a .fai index
+FaiEntry = collections.namedtuple("FaiEntry", ["length", "offset",
+                                               "line_bases", "line_width"])
+
+
+class FaidxError(Exception):
+    """Raised when a fasta file cannot be indexed or read from its index."""
+
+
+def index_filename(filename):
+    """
+    This function gives the name of the .fai index of a fasta file.
+    :param: filename -- Name of the fasta file.
+    :return: The name of the index file.
+    """
+    return filename + ".fai"
+
+
+def build_index(filename):
+    """
+    This function reads through a fasta file once and writes its .fai index.
+    Every line of a sequence except the last must have the same length.
+    Offsets of BGZF compressed files are offsets into the decompressed data.
+    :param: filename -- Name of the uncompressed or BGZF compressed fasta
+                        file.
+    :return: index -- A dictionary where keys are sequence names (the header up
+                      to the first whitespace) and values are FaiEntry tuples.
+    """
+    index = {}
+    name = None
+    offset = 0
+    if bgzf.is_bgzf(filename):
+        infile = gzip.open(filename, "rb")
+    else:
+        infile = open(filename, "rb")
+    with infile:
+        for line in infile:
+            if line.startswith(b">"):
+                if name is not None:
+                    index[name] = FaiEntry(length, seq_offset, line_bases,
+                                           line_width)
+                name = line[1:].split(None, 1)[0].decode("utf-8")
+                if name in index:
+                    raise FaidxError("Duplicate sequence name " + name)
+                seq_offset = offset + len(line)
+                length = line_bases = line_width = 0
+                last_short = False
+            elif name is not None:
+                bases = len(line.rstrip(b"\r\n"))
+                if line_bases == 0:
+                    line_bases = bases
+                    line_width = len(line)
+                elif last_short or bases > line_bases:
+                    raise FaidxError("Sequence " + name + " has lines of "
+                                     "different lengths")
+                last_short = bases < line_bases
+                length += bases
+            offset += len(line)
+        if name is not None:
+            index[name] = FaiEntry(length, seq_offset, line_bases, line_width)
+
+    with open(index_filename(filename), "w") as fai:
+        for name, entry in index.items():
+            fai.write("\t".join([name] + [str(field) for field in entry]) +
+                      "\n")
+    return index
+
+
+def read_index(filename):
+    """
+    This function reads the .fai index of a fasta file.
+    :param: filename -- Name of the fasta file (not of the index).
+    :return: index -- A dictionary where keys are sequence names and values
+                      are FaiEntry tuples.
+    """
+    index = {}
+    with open(index_filename(filename)) as fai:
+        for line in fai:
+            fields = line.rstrip("\n").split("\t")
+            index[fields[0]] = FaiEntry(*[int(field) for field in fields[1:5]])
+    return index
+
+
+def load_index(filename):
+    """
+    This function returns the index of a fasta file, building it first if it
+    does not exist yet or is older than the fasta file.
+    :param: filename -- Name of the fasta file.
+    :return: index -- A dictionary where keys are sequence names and values
+                      are FaiEntry tuples.
+    """
+    fai = index_filename(filename)
+    if os.path.exists(fai) and \
+            os.path.getmtime(fai) >= os.path.getmtime(filename):
+        return read_index(filename)
+    return build_index(filename)
+
+
+class FastaFile:
+    """
+    An indexed fasta file. Uncompressed files are memory-mapped and BGZF
+    compressed files are read through a bgzf.BgzfReader. fetch() reads only
+    the bytes that hold the requested bases, so a lookup takes the same time
+    wherever the bases are in the file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.index = load_index(filename)
+        if bgzf.is_bgzf(filename):
+            self._file = bgzf.BgzfReader(filename)
+            self._read = self._file.read_at
+            self._data = None
+            return
+
+        self._file = open(filename, "rb")
+        if os.path.getsize(filename):
+            self._data = mmap.mmap(self._file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        else:
+            self._data = b""
+
+    def _read(self, offset, size):
+        return self._data[offset:offset + size]
+
+    def fetch(self, name, start, end):
+        """
+        This function returns the bases of a sequence from start up to but not
+        including end, counting from 0. The range is clipped to the length of
+        the sequence.
+        :params: name -- Name of the sequence.
+
+                 start -- Index of the first base.
+
+                 end -- Index one past the last base.
+        :return: A bytes object of the bases.
+        """
+        try:
+            entry = self.index[name]
+        except KeyError:
+            raise FaidxError("Sequence " + name + " is not in " +
+                             self.filename) from None
+        start = max(start, 0)
+        end = min(end, entry.length)
+        if start >= end:
+            return b""
+
+        # Byte offsets of the first and last base, skipping over the line
+        # endings before them
+        first = entry.offset + start // entry.line_bases * entry.line_width + \
+            start % entry.line_bases
+        last = entry.offset + (end - 1) // entry.line_bases * \
+            entry.line_width + (end - 1) % entry.line_bases
+        data = self._read(first, last - first + 1)
+        return data.replace(b"\n", b"").replace(b"\r", b"")
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -2,10 +2,29 @@
 '''
 Author: Maya Bose
 Date: 5/17/2019
-This program converts a fastq file to a fasta file.
+This program converts a fastq file to a fasta file. With --collapse, each
+unique sequence is written once, with the number of reads that have it in its
+header. If there are too many unique sequences to hold in memory, they are
+spilled to bucket files on disk by hash, and each bucket is collapsed and
+sorted on its own before the buckets are merged.
 '''
 import gzip
 import argparse
+import collections
+import heapq
+import itertools
+import operator
+import os
+import sys
+import tempfile
+
+import fastq_io
+
+# Number of reads to hold in memory before writing them to stdout
+WRITE_BATCH = 10000
+
+# Number of bucket files unique sequences are spilled to
+BUCKETS = 64
 
 
 def main():
@@ -19,28 +38,126 @@ def get_args():
         description="Converts a fastq file to fasta format")
     parser.add_argument('Filename', metavar='f', type=str, nargs=1,
                         help='a fastq file')
+    parser.add_argument('--collapse', action='store_true', help='Write each\
+    unique sequence once, with a header of >{rank}-{read count}')
+    parser.add_argument('--sort', choices=['abundance', 'sequence'],
+                        default='abundance', help='Order of collapsed\
+    sequences: most reads first (the default), or by sequence')
+    parser.add_argument('--max_in_memory', type=int, default=10000000,
+                        help='Most unique sequences to hold in memory before\
+    spilling them to disk')
+    parser.add_argument('--tmp_dir', type=str, help='Directory to spill\
+    unique sequences to. Set to the system temporary directory by default')
     args = parser.parse_args()
+    if args.max_in_memory < 1:
+        parser.error('--max_in_memory must be at least 1')
     d = vars(args)
 
     return d
 
 def convert(d):
-    i = 0
-    with gzip.open(d['Filename'][0], 'r') as the_file:
-        for line in the_file:
-            line = line.decode('utf-8')
-            line = line.strip()
-
-            if i == 0:
-                line = '>' + line[1:]  # Changes fastq '@' character to fasta
-                                       # '>' character
-
-            if i == 0 or i == 1:  # Don't print deliminator ('+') or quality                             
-                print(line)       # encoding
-
-            i += 1
-            if i == 4:
-                i = 0
+    if d['collapse']:
+        collapse(d)
+        return
+
+    out = sys.stdout.buffer
+    with gzip.open(d['Filename'][0], 'rb') as the_file:
+        buffer = []
+        for record in fastq_io.read_records(the_file):
+            # Changes fastq '@' character to fasta '>' character. The
+            # deliminator ('+') and quality encoding are not printed
+            buffer.append(fastq_io.format_fasta(record))
+            if len(buffer) >= WRITE_BATCH:
+                out.write(b''.join(buffer))
+                buffer = []
+        out.write(b''.join(buffer))
+
+
+def sort_key(d):
+    # Most reads first, ties broken by sequence, or by sequence alone
+    if d['sort'] == 'abundance':
+        return lambda item: (-item[1], item[0])
+    return operator.itemgetter(0)
+
+
+def collapse(d):
+    key = sort_key(d)
+    with tempfile.TemporaryDirectory(dir=d['tmp_dir']) as tmp_dir:
+        with gzip.open(d['Filename'][0], 'rb') as the_file:
+            counts, buckets = count_sequences(the_file, d['max_in_memory'],
+                                              tmp_dir)
+        if buckets is None:
+            items = sorted(counts.items(), key=key)
+        else:
+            # Every copy of a sequence is in the same bucket, so each bucket
+            # can be collapsed on its own. Each is sorted and saved as a run,
+            # and the runs are merged into one sorted list.
+            spill(counts, buckets)
+            for bucket in buckets:
+                bucket.close()
+            runs = [sort_bucket(bucket.name, key) for bucket in buckets]
+            items = heapq.merge(*[read_bucket(run) for run in runs], key=key)
+        write_collapsed(items)
+
+
+def count_sequences(the_file, max_in_memory, tmp_dir):
+    # Count the reads of each sequence, a batch of reads at a time. Once there
+    # are more unique sequences than max_in_memory, the counts are spilled to
+    # the bucket files and counting starts again from empty.
+    counts = collections.Counter()
+    buckets = None
+    seqs = map(operator.itemgetter(1), fastq_io.read_records(the_file))
+    while True:
+        batch = list(itertools.islice(seqs, WRITE_BATCH))
+        if not batch:
+            break
+        counts.update(batch)
+        if len(counts) > max_in_memory:
+            if buckets is None:
+                buckets = [open(os.path.join(tmp_dir, str(i)), 'wb')
+                           for i in range(BUCKETS)]
+            spill(counts, buckets)
+            counts = collections.Counter()
+    return counts, buckets
+
+
+def spill(counts, buckets):
+    # Append each sequence and its count to the bucket picked by its hash
+    lines = [[] for _ in buckets]
+    for seq, n in counts.items():
+        lines[hash(seq) % len(buckets)].append(seq + b'\t' + str(n).encode() +
+                                               b'\n')
+    for bucket, bucket_lines in zip(buckets, lines):
+        bucket.write(b''.join(bucket_lines))
+
+
+def read_bucket(filename):
+    with open(filename, 'rb') as bucket:
+        for line in bucket:
+            seq, n = line.split(b'\t')
+            yield seq, int(n)
+
+
+def sort_bucket(filename, key):
+    # Collapse the counts in a bucket and write them back sorted
+    counts = collections.Counter()
+    for seq, n in read_bucket(filename):
+        counts[seq] += n
+    with open(filename, 'wb') as bucket:
+        bucket.write(b''.join(seq + b'\t' + str(n).encode() + b'\n'
+                              for seq, n in sorted(counts.items(), key=key)))
+    return filename
+
+
+def write_collapsed(items):
+    out = sys.stdout.buffer
+    buffer = []
+    for rank, (seq, n) in enumerate(items, 1):
+        buffer.append(b'>%d-%d\n%s\n' % (rank, n, seq))
+        if len(buffer) >= WRITE_BATCH:
+            out.write(b''.join(buffer))
+            buffer = []
+    out.write(b''.join(buffer))
 
 
 main()
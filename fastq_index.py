@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Indexed access to the reads of a fastq file by read name. The index is written
+next to the fastq file as a .fqi file: a sorted array of 64-bit hashes of the
+read names, followed by the byte offset of each read, all as little-endian
+64-bit integers. The index is memory-mapped and searched by bisection, so it
+takes 16 bytes per read on disk and almost nothing in memory, and once built
+it can be used by any number of runs against the same fastq file. Fastq files
+compressed with BGZF are read through their .gzi block index, as with faidx.
+"""
+__author__ = "boseHere"
+import array
+import bisect
+import gzip
+import hashlib
+import mmap
+import os
+import struct
+import sys
+
+import numpy as np
+
+import bgzf
+
+# Start of every .fqi file, followed by the number of reads
+MAGIC = b"FQI\x01"
+
+# Number of bytes read at an offset to get a whole read. Longer reads are
+# read again with more.
+READ_SIZE = 1024
+
+
+class FastqIndexError(Exception):
+    """Raised when a fastq file cannot be indexed or read from its index."""
+
+
+def index_filename(filename):
+    """
+    This function gives the name of the .fqi index of a fastq file.
+    :param: filename -- Name of the fastq file.
+    :return: The name of the index file.
+    """
+    return filename + ".fqi"
+
+
+def name_hash(name):
+    """
+    This function hashes a read name to a 64-bit integer.
+    :param: name -- A bytes object of the read name (the header up to the first
+                    whitespace, including the @).
+    :return: An integer from 0 to 2 ** 64 - 1.
+    """
+    return int.from_bytes(hashlib.blake2b(name, digest_size=8).digest(),
+                          "little")
+
+
+def build_index(filename):
+    """
+    This function reads through a fastq file once and writes its .fqi index.
+    Offsets of BGZF compressed files are offsets into the decompressed data.
+    Hashes and offsets are kept in two arrays of 8 bytes per read and sorted
+    together at the end. Blank lines between reads are skipped.
+    :param: filename -- Name of the uncompressed or BGZF compressed fastq file.
+    :return: none
+    """
+    hashes = array.array("Q")
+    offsets = array.array("Q")
+    offset = 0
+    line_number = 0  # Line of the current read, from 0 to 3
+    if bgzf.is_bgzf(filename):
+        infile = gzip.open(filename, "rb")
+    elif filename.endswith(".gz"):
+        raise FastqIndexError(filename + " is gzipped but not in BGZF format")
+    else:
+        infile = open(filename, "rb")
+    with infile:
+        for line in infile:
+            if line_number == 0:
+                name = line.split(None, 1)
+                if not name:
+                    offset += len(line)
+                    continue
+                hashes.append(name_hash(name[0]))
+                offsets.append(offset)
+            line_number = (line_number + 1) % 4
+            offset += len(line)
+
+    # A stable sort keeps reads with the same hash in file order
+    hashes = np.frombuffer(hashes, dtype=np.uint64)
+    order = np.argsort(hashes, kind="stable")
+    with open(index_filename(filename), "wb") as fqi:
+        fqi.write(MAGIC + struct.pack("<Q", len(order)))
+        fqi.write(hashes[order].astype("<u8").tobytes())
+        fqi.write(np.frombuffer(offsets, dtype=np.uint64)[order]
+                  .astype("<u8").tobytes())
+
+
+def load_index(filename):
+    """
+    This function builds the index of a fastq file if it does not exist yet or
+    is older than the fastq file.
+    :param: filename -- Name of the fastq file.
+    :return: The name of the index file.
+    """
+    fqi = index_filename(filename)
+    if not os.path.exists(fqi) or \
+            os.path.getmtime(fqi) < os.path.getmtime(filename):
+        build_index(filename)
+    return fqi
+
+
+class FastqIndex:
+    """
+    An indexed fastq file. Looking up a read name finds its hash in the index
+    and reads only the bytes of the matching read; reads are checked against
+    the name, so a hash shared by two names still finds the right read.
+    Uncompressed fastq files are memory-mapped and BGZF compressed files are
+    read through a bgzf.BgzfReader.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._index_file = open(load_index(filename), "rb")
+        self._index = mmap.mmap(self._index_file.fileno(), 0,
+                                access=mmap.ACCESS_READ)
+        if self._index[:4] != MAGIC:
+            self.close()
+            raise FastqIndexError(index_filename(filename) +
+                                  " is not a .fqi index")
+        count = struct.unpack("<Q", self._index[4:12])[0]
+        self._hashes = self._cast(12, count)
+        self._offsets = self._cast(12 + 8 * count, count)
+
+        if bgzf.is_bgzf(filename):
+            self._file = bgzf.BgzfReader(filename)
+            self._read = self._file.read_at
+            self._data = None
+            return
+
+        self._file = open(filename, "rb")
+        if os.path.getsize(filename):
+            self._data = mmap.mmap(self._file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        else:
+            self._data = b""
+
+    def _cast(self, offset, count):
+        values = memoryview(self._index)[offset:offset + 8 * count].cast("Q")
+        if sys.byteorder != "little":
+            values = array.array("Q", values)
+            values.byteswap()
+        return values
+
+    def _read(self, offset, size):
+        return self._data[offset:offset + size]
+
+    def _record(self, offset):
+        # Read the four lines of the read that starts at offset
+        size = READ_SIZE
+        while True:
+            data = self._read(offset, size)
+            lines = data.split(b"\n", 4)
+            if len(lines) == 5 or len(data) < size:
+                return [line.rstrip(b"\r") for line in lines[:4]]
+            size *= 2
+
+    def __contains__(self, name):
+        try:
+            self[name]
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, name):
+        """
+        This function returns the read with a given name.
+        :param: name -- A bytes object of the read name (the header up to the
+                        first whitespace, including the @).
+        :return: A tuple of the (sequence, separator, quality) lines of the
+                 read. KeyError is raised if there is no read with the name.
+        """
+        key = name_hash(name)
+        i = bisect.bisect_left(self._hashes, key)
+        while i < len(self._hashes) and self._hashes[i] == key:
+            header, seq, sep, qual = self._record(self._offsets[i])
+            if header.split(None, 1)[0] == name:
+                return seq, sep, qual
+            i += 1
+        raise KeyError(name)
+
+    def close(self):
+        # Release the views of the index before the map they point into
+        self._hashes = self._offsets = None
+        self._index.close()
+        self._index_file.close()
+        if hasattr(self, "_file"):
+            if isinstance(self._data, mmap.mmap):
+                self._data.close()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
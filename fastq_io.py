@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+"""
+Shared input helpers for the fastq scripts in this directory. Reads are parsed
+from large binary blocks and handed out as tuples of bytes, so the scripts no
+longer decode and strip every line one at a time. Reads can also be collapsed
+into a table of unique sequences and their counts, which can be saved and
+given to the scripts in place of the fastq file.
+"""
+__author__ = "boseHere"
+import collections
+import concurrent.futures
+import gzip
+import operator
+import os
+import queue
+import threading
+
+import bgzf
+
+# Number of bytes read from a file at a time
+BLOCK_SIZE = 1 << 20
+
+# Number of decompressed chunks the background thread may get ahead of the
+# parser
+QUEUE_SIZE = 8
+
+# Number of BGZF blocks (up to 64 KB each) decompressed together by a worker
+BGZF_BATCH = 16
+
+# Ending given to saved tables of unique sequences and their counts
+COLLAPSED_SUFFIX = ".collapsed.tsv"
+
+
+def open_input(filename, threads=1):
+    """
+    This function opens a fastq or fasta file for binary reading.
+    :params: filename -- Name of the file. Files ending in ".gz" are opened
+                         with open_gzip.
+
+             threads -- Number of threads to decompress gzipped files with.
+    :return: A binary file object to be read from.
+    """
+    if filename.endswith(".gz"):
+        return open_gzip(filename, threads)
+    return open(filename, "rb")
+
+
+def open_gzip(filename, threads=1):
+    """
+    This function opens a gzipped file for binary reading. With more than one
+    thread, the file is decompressed on a background thread while the caller
+    parses it, and BGZF files are decompressed a batch of blocks per thread.
+    :params: filename -- Name of the gzipped file.
+
+             threads -- Number of threads to decompress the file with.
+    :return: A binary file object to be read from.
+    """
+    if threads <= 1:
+        return gzip.open(filename, "rb")
+    return ThreadedReader(filename, threads)
+
+
+class ThreadedReader:
+    """
+    A read-only binary file object that decompresses a gzipped file on a
+    background thread. Decompressed data is handed to the reader through a
+    bounded queue, so memory use stays at a few chunks no matter the file
+    size. read() returns whole chunks as they become available rather than
+    exactly the number of bytes asked for.
+    """
+
+    def __init__(self, filename, threads):
+        self.threads = threads
+        self._raw = open(filename, "rb")
+        self._bgzf = bgzf.is_bgzf(filename)
+        self._queue = queue.Queue(QUEUE_SIZE)
+        self._stop = threading.Event()
+        self._done = False
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        # Give up on the queue if the reader has been closed early
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self):
+        try:
+            if self._bgzf:
+                self._produce_bgzf()
+            else:
+                with gzip.GzipFile(fileobj=self._raw) as infile:
+                    chunk = infile.read(BLOCK_SIZE)
+                    while chunk and self._put(chunk):
+                        chunk = infile.read(BLOCK_SIZE)
+        except Exception as error:
+            self._put(error)
+        self._put(None)
+
+    def _produce_bgzf(self):
+        with concurrent.futures.ThreadPoolExecutor(self.threads) as pool:
+            pending = collections.deque()
+            batch = []
+            for block in bgzf.read_blocks(self._raw):
+                batch.append(block)
+                if len(batch) == BGZF_BATCH:
+                    pending.append(pool.submit(bgzf.inflate_blocks, batch))
+                    batch = []
+                    # Keep the output in file order while letting the workers
+                    # run a few batches ahead
+                    if len(pending) > 2 * self.threads:
+                        if not self._put(pending.popleft().result()):
+                            return
+            if batch:
+                pending.append(pool.submit(bgzf.inflate_blocks, batch))
+            while pending:
+                if not self._put(pending.popleft().result()):
+                    return
+
+    def read(self, size=-1):
+        """
+        This function returns the next chunk of decompressed data, or an empty
+        bytes object at the end of the file. With a negative size, the rest of
+        the file is returned.
+        """
+        if size is None or size < 0:
+            return b"".join(iter(lambda: self.read(BLOCK_SIZE), b""))
+        while not self._done:
+            item = self._queue.get()
+            if item is None:
+                self._done = True
+            elif isinstance(item, Exception):
+                self._done = True
+                raise item
+            elif item:
+                return item
+        return b""
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self._raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_lines(infile, block_size=BLOCK_SIZE):
+    """
+    This function reads a binary file object in large blocks and yields lists
+    of complete lines (without their line endings).
+    :params: infile -- A binary file object to be read from.
+
+             block_size -- Number of bytes to read at a time.
+    :return: A generator of lists of bytes objects, one per line.
+    """
+    leftover = b""
+    while True:
+        block = infile.read(block_size)
+        if not block:
+            break
+        if b"\r" in block:
+            block = block.replace(b"\r", b"")
+        lines = (leftover + block).split(b"\n")
+        leftover = lines.pop()
+        yield lines
+
+    if leftover:
+        yield [leftover]
+
+
+def read_records(infile, block_size=BLOCK_SIZE):
+    """
+    This function yields the reads of a fastq file as tuples of four bytes
+    objects: (header, sequence, separator, quality). Nothing is decoded and no
+    line endings are kept.
+    :params: infile -- A binary file object to be read from.
+
+             block_size -- Number of bytes to read at a time.
+    :return: A generator of 4-tuples of bytes objects.
+    """
+    pending = []
+    for lines in read_lines(infile, block_size):
+        if pending:
+            lines = pending + lines
+
+        # Only hand out whole reads; the remaining 1-3 lines are carried over
+        # to the next block
+        end = len(lines) - len(lines) % 4
+        pending = lines[end:]
+        if end:
+            records = iter(lines[:end])
+            yield from zip(records, records, records, records)
+
+
+def read_chunks(infile, block_size=BLOCK_SIZE):
+    """
+    This function reads a fastq file in large blocks and yields them cut at
+    read boundaries, so each chunk holds only whole reads and can be parsed on
+    its own, e.g. by another process. Only newlines are counted; nothing is
+    split into lines.
+    :params: infile -- A binary file object to be read from.
+
+             block_size -- Number of bytes to read at a time.
+    :return: A generator of bytes objects.
+    """
+    leftover = b""
+    while True:
+        block = infile.read(block_size)
+        if not block:
+            break
+        data = leftover + block
+
+        # Cut after the last newline that ends a read: skip back over the
+        # lines of any read that is not yet complete, and the partial line
+        # after them
+        end = len(data)
+        for _ in range(data.count(b"\n") % 4 + 1):
+            end = data.rfind(b"\n", 0, end)
+            if end == -1:
+                break
+        if end == -1:
+            leftover = data
+            continue
+        leftover = data[end + 1:]
+        yield data[:end + 1]
+
+    if leftover:
+        yield leftover
+
+
+def format_record(record):
+    """
+    This function joins a read back into fastq text.
+    :param: record -- A 4-tuple of bytes objects as yielded by read_records.
+    :return: A bytes object with the four lines of the read, newline
+             terminated.
+    """
+    return b"\n".join(record) + b"\n"
+
+
+def trim_record(record, target):
+    """
+    This function cuts the sequence and quality of a read down to a target
+    length. Reads no longer than the target are returned as they are (slicing
+    a bytes object past its end gives back the same object, so no length
+    check is needed).
+    :params: record -- A 4-tuple of bytes objects as yielded by read_records.
+
+             target -- Longest length to keep.
+    :return: A 4-tuple of bytes objects.
+    """
+    header, seq, sep, qual = record
+    return header, seq[:target], sep, qual[:target]
+
+
+def format_fasta(record):
+    """
+    This function turns a read into fasta text. The fastq '@' is changed to
+    the fasta '>', and the separator and quality lines are dropped.
+    :param: record -- A 4-tuple of bytes objects as yielded by read_records.
+    :return: A bytes object with the two lines of the fasta record, newline
+             terminated.
+    """
+    return b">" + record[0].strip()[1:] + b"\n" + record[1].strip() + b"\n"
+
+
+def collapse(infile):
+    """
+    This function counts how many reads of a fastq file have each sequence.
+    :param: infile -- A binary file object to be read from.
+    :return: counts -- A Counter where keys are sequences (as bytes) and values
+                       are the number of reads with that sequence.
+    """
+    counts = collections.Counter()
+    counts.update(map(operator.itemgetter(1), read_records(infile)))
+    return counts
+
+
+def is_collapsed(filename):
+    """
+    This function tests whether a file is a table of collapsed reads rather
+    than a fastq file, going by its name.
+    :param: filename -- Name of the file.
+    :return: A boolean. True if the file name ends in .tsv or .tsv.gz.
+    """
+    return filename.endswith((".tsv", ".tsv.gz"))
+
+
+def write_collapsed(counts, filename):
+    """
+    This function saves collapsed reads as a tab-separated table of sequence
+    and count, most common sequence first.
+    :params: counts -- A Counter of sequences as made by collapse.
+
+             filename -- Name of the file to write to. Gzipped if it ends in
+                         .gz.
+    :return: none
+    """
+    if filename.endswith(".gz"):
+        outfile = gzip.open(filename, "wb")
+    else:
+        outfile = open(filename, "wb")
+    with outfile:
+        outfile.write(b"".join(seq + b"\t" + str(n).encode() + b"\n"
+                               for seq, n in counts.most_common()))
+
+
+def read_collapsed(filename, threads=1):
+    """
+    This function reads a table of collapsed reads saved by write_collapsed.
+    :params: filename -- Name of the table.
+
+             threads -- Number of threads to decompress a gzipped table with.
+    :return: counts -- A Counter where keys are sequences (as bytes) and values
+                       are the number of reads with that sequence.
+    """
+    counts = collections.Counter()
+    with open_input(filename, threads) as infile:
+        for lines in read_lines(infile):
+            for line in lines:
+                if line:
+                    seq, n = line.split(b"\t")
+                    counts[seq] += int(n)
+    return counts
+
+
+def load_collapsed(filename, threads=1, save_dir=None):
+    """
+    This function gives the collapsed reads of a fastq file, or reads them
+    from the file if it is already a collapsed table.
+    :params: filename -- Name of a fastq file or of a collapsed table.
+
+             threads -- Number of threads to decompress a gzipped file with.
+
+             save_dir -- Optional directory to save the collapsed reads of a
+                         fastq file to, as {file name} + COLLAPSED_SUFFIX, so
+                         they can be given in place of the fastq file later.
+    :return: counts -- A Counter where keys are sequences (as bytes) and values
+                       are the number of reads with that sequence.
+    """
+    if is_collapsed(filename):
+        return read_collapsed(filename, threads)
+
+    with open_input(filename, threads) as infile:
+        counts = collapse(infile)
+    if save_dir is not None:
+        write_collapsed(counts, os.path.join(
+            save_dir, os.path.basename(filename) + COLLAPSED_SUFFIX))
+    return counts
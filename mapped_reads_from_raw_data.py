@@ -4,12 +4,32 @@ Author: Maya Bose
 Date: 7/30/19
 Purpose: Given a fastq file of reads that mapped to a reference genome and a
 fastq file of raw reads, this program retrieves the reads from the file of raw
-data that are present in the file of mapped reads.
+data that are present in the file of mapped reads. With --streaming, only the
+names of the mapped reads are held in memory while the raw file is read once;
+if there are too many names even for that, both files are sorted on disk in
+bounded-size runs and merged. With --index, the raw reads are looked up in a
+.fqi index saved next to the raw file instead, so repeated runs against the
+same raw file neither load nor read through all of it. The mapped reads can
+be given as a SAM file straight from the aligner, in which case only the names
+of mapped primary alignments are used, each read once.
 """
 __author__ = "boseHere"
 import argparse
-import gzip
+import heapq
+import itertools
 import os
+import tempfile
+
+import bgzf
+import fastq_index
+import fastq_io
+
+# Number of reads to hold in memory before writing them to the output file
+WRITE_BATCH = 10000
+
+# SAM flags of alignments that are skipped: unmapped, secondary and
+# supplementary. This leaves one primary alignment per mapped read.
+SKIP_FLAGS = 0x4 | 0x100 | 0x800
 
 def get_args():
     """
@@ -27,14 +47,46 @@ def get_args():
     parser.add_argument("input_raw", type=str,
                         help="Fastq filename with raw reads")
     parser.add_argument("input_mapped", type=str,
-                        help="Fastq filename with reads that have mapped to "
-                             "the genome")
-    parser.add_argument("--gzip", help="Gzip the output file",
+                        help="Fastq or SAM filename with reads that have "
+                             "mapped to the genome")
+    parser.add_argument("--sam", action="store_true",
+                        help="Read the mapped reads file as SAM. Files ending "
+                             "in .sam or .sam.gz are always read as SAM")
+    parser.add_argument("--gzip", help="Gzip the output file. The output is "
+                                       "written in BGZF format, which can be "
+                                       "read by any gzip tool",
                         action="store_true")
+    parser.add_argument("--compression_level", type=int, default=6,
+                        help="Gzip compression level of the output file, from "
+                             "0 (fastest) to 9 (smallest). Set to 6 by default")
     parser.add_argument("--output_dir", nargs="?", type=str, const="./",
                         default="./", help="Directory location for output file."
                                            " Set to current directory by "
                                            "default")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Number of threads to decompress gzipped input "
+                             "and compress gzipped output with. Set to 1 by "
+                             "default")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Hold only the names of the mapped reads in "
+                             "memory instead of every raw read. Reads are "
+                             "written in the order of the raw file, each one "
+                             "once")
+    parser.add_argument("--max_in_memory", type=int, default=10000000,
+                        help="With --streaming, the most read names to hold "
+                             "in memory. Past this, the reads are sorted on "
+                             "disk in runs of this many reads and merged, and "
+                             "are written in order of read name. Set to "
+                             "10000000 by default")
+    parser.add_argument("--index", action="store_true",
+                        help="Look up the mapped reads in an index of the raw "
+                             "file, built on the first run and kept next to "
+                             "it as {input_raw}.fqi. The raw file must be "
+                             "uncompressed or BGZF compressed")
+    parser.add_argument("--tmp_dir", type=str, default=None,
+                        help="Directory for the sorted runs of --streaming. "
+                             "Set to the system temporary directory by "
+                             "default")
     args = parser.parse_args()
     return args
 
@@ -78,6 +130,20 @@ def create_params(args):
         gzipped1 = False
 
     gzipped2 = (args.input_mapped[-3:] == ".gz")
+    if args.input_mapped.endswith((".sam", ".sam.gz")):
+        args.sam = True
+
+    if args.index and args.streaming:
+        print("Only one of --index and --streaming can be used")
+        exit(1)
+
+    if args.max_in_memory < 1:
+        print("Maximum reads in memory must be at least 1")
+        exit(1)
+
+    if not 0 <= args.compression_level <= 9:
+        print("Compression level must be between 0 and 9")
+        exit(1)
 
     # If the --gzip option has been used, add the gzip file extension to the
     # output file name
@@ -89,8 +155,8 @@ def create_params(args):
 
 def open_files(args, outfile, gzipped1, gzipped2):
     """
-    This function opens the input file for reading and opens the output file
-    for writing.
+    This function opens the input files for reading and opens the output file
+    for writing. All files are opened in binary mode.
     :params: args -- An argparse object. Elements of the object can be accessed
                      by their option name as attributes (e.g. args.gzip returns
                      the user input for the gzip option)
@@ -102,27 +168,33 @@ def open_files(args, outfile, gzipped1, gzipped2):
     """
     try:
         if args.gzip:
-            writefile = gzip.open(outfile, "w+")
+            writefile = bgzf.BgzfWriter(outfile, args.compression_level,
+                                        args.threads)
         else:
-            writefile = open(outfile, "w+")
+            writefile = open(outfile, "wb")
     except FileNotFoundError:
         print("Output directory does not exist")
         exit(1)
 
     try:
-        if gzipped1:
-            infile1 = gzip.open(args.input_raw, "r")
+        if args.index:
+            infile1 = fastq_index.FastqIndex(args.input_raw)
+        elif gzipped1:
+            infile1 = fastq_io.open_gzip(args.input_raw, args.threads)
         else:
-            infile1 = open(args.input_raw, "r")
+            infile1 = open(args.input_raw, "rb")
     except FileNotFoundError:
         print("Raw data input file does not exist")
         exit(1)
+    except fastq_index.FastqIndexError as error:
+        print(error)
+        exit(1)
 
     try:
         if gzipped2:
-            infile2 = gzip.open(args.input_mapped, "r")
+            infile2 = fastq_io.open_gzip(args.input_mapped, args.threads)
         else:
-            infile2 = open(args.input_mapped, "r")
+            infile2 = open(args.input_mapped, "rb")
     except FileNotFoundError:
         print("Mapped data input file does not exist")
         exit(1)
@@ -130,59 +202,290 @@ def open_files(args, outfile, gzipped1, gzipped2):
     return infile1, infile2, writefile
 
 
-def raw_reads_dictionary(infile1, gzipped1):
-    i = 0
+def raw_reads_dictionary(infile1):
+    """
+    This function stores every read of the raw data file in a dictionary.
+    :param: infile1 -- A binary file object of raw reads to be read from.
+    :return: reads -- A dictionary where keys are read names (the header up to
+                      the first whitespace) and values are the remaining
+                      (sequence, separator, quality) lines of the read.
+    """
     reads = {}
-    for line in infile1:
-        if gzipped1:
-            line = line.decode("utf-8")
-        line = line.strip()
-        if i == 0:
-            line1 = line.split()
-            line1 = line1[0]
-            reads[line1] = []
-        elif i == 1 or i == 2 or i == 3:
-            reads[line1].append(line)
-        i += 1
-        if i == 4:
-            i = 0
+    for header, seq, sep, qual in fastq_io.read_records(infile1):
+        reads[header.split(None, 1)[0]] = (seq, sep, qual)
     return reads
 
 
-def intersect_reads(args, reads, infile2, gzipped2, writefile):
-    i = 0
-    for line in infile2:
-        if gzipped2:
-            line = line.decode("utf-8")
-        line = line.strip()
-        if i == 0:
-            line1 = line + "\n"
-            line2 = reads[line][0] + "\n"
-            line3 = reads[line][1] + "\n"
-            line4 = reads[line][2] + "\n"
-
-            if args.gzip:
-                line1 = line1.encode("utf-8")
-                line2 = line2.encode("utf-8")
-                line3 = line3.encode("utf-8")
-                line4 = line4.encode("utf-8")
-
-            writefile.write(line1)
-            writefile.write(line2)
-            writefile.write(line3)
-            writefile.write(line4)
-
-        i += 1
-        if i == 4:
-            i = 0
+def intersect_reads(reads, names, writefile):
+    """
+    This function writes the raw data for every read in the mapped reads file
+    to the output file.
+    :params: reads -- A dictionary of raw reads as made by raw_reads_dictionary,
+                      or a fastq_index.FastqIndex of the raw data file.
+
+             names -- An iterable of the names of the mapped reads, as given
+                      by mapped_read_names.
+
+             writefile -- A binary file object to be written to.
+    :return: none
+    """
+    buffer = []
+    for header in names:
+        buffer.append(fastq_io.format_record((header,) + reads[header]))
+        if len(buffer) >= WRITE_BATCH:
+            writefile.write(b"".join(buffer))
+            buffer = []
+
+    writefile.write(b"".join(buffer))
+
+
+def write_records(records, writefile):
+    """
+    This function writes reads to the output file in large chunks.
+    :params: records -- An iterable of reads as 4-tuples of bytes objects.
+
+             writefile -- A binary file object to be written to.
+    :return: none
+    """
+    buffer = []
+    for record in records:
+        buffer.append(fastq_io.format_record(record))
+        if len(buffer) >= WRITE_BATCH:
+            writefile.write(b"".join(buffer))
+            buffer = []
+
+    writefile.write(b"".join(buffer))
+
+
+def mapped_read_names(infile2, sam=False, unique=True):
+    """
+    This function yields the name (the header up to the first whitespace) of
+    every read in the mapped reads file.
+    :params: infile2 -- A binary file object of mapped reads to be read from.
+
+             sam -- A boolean. True if the file is in SAM format, in which case
+                    the names are given by sam_read_names.
+
+             unique -- A boolean passed on to sam_read_names.
+    :return: A generator of read names (as bytes).
+    """
+    if sam:
+        yield from sam_read_names(infile2, unique)
+        return
+    for record in fastq_io.read_records(infile2):
+        yield record[0].split(None, 1)[0]
+
+
+def sam_read_names(infile2, unique=True):
+    """
+    This function yields the names of the reads of a SAM file that have a
+    mapped primary alignment. Names are given an @ in front so they match the
+    headers of the raw fastq file. Header lines are skipped.
+    :params: infile2 -- A binary file object of a SAM file to be read from.
+
+             unique -- A boolean. True to yield each name once, which keeps a
+                       set of every name seen. Streaming mode passes False,
+                       as it removes repeated names itself.
+    :return: A generator of read names (as bytes).
+    """
+    seen = set()
+    for lines in fastq_io.read_lines(infile2):
+        for line in lines:
+            if not line or line.startswith(b"@"):
+                continue
+            name, flag, _ = line.split(b"\t", 2)
+            if int(flag) & SKIP_FLAGS:
+                continue
+            if unique:
+                if name in seen:
+                    continue
+                seen.add(name)
+            yield b"@" + name
+
+
+def raw_reads_by_name(infile1):
+    """
+    This function yields every read of the raw data file with its header cut
+    down to the read name, which is how it is written to the output file.
+    :param: infile1 -- A binary file object of raw reads to be read from.
+    :return: A generator of reads as 4-tuples of bytes objects.
+    """
+    for header, seq, sep, qual in fastq_io.read_records(infile1):
+        yield header.split(None, 1)[0], seq, sep, qual
+
+
+def stream_reads(args, infile1, infile2, writefile):
+    """
+    This function collects the names of the mapped reads in a set, then reads
+    through the raw data file once and writes every read whose name is in the
+    set. If there are more than args.max_in_memory names, it falls back to
+    sort_merge_reads. Either way, if any mapped read is not in the raw data
+    file the program stops with an error, as the default mode does.
+    :params: args -- An argparse object. Elements of the object can be accessed
+                     by their option name as attributes (e.g. args.gzip returns
+                     the user input for the gzip option)
+
+             infile1 -- A binary file object of raw reads to be read from.
+
+             infile2 -- A binary file object of mapped reads to be read from.
+
+             writefile -- A binary file object to be written to.
+    :return: none
+    """
+    names = set()
+    mapped = mapped_read_names(infile2, args.sam, unique=False)
+    for name in mapped:
+        names.add(name)
+        if len(names) > args.max_in_memory:
+            try:
+                sort_merge_reads(args, infile1,
+                                 itertools.chain(names, mapped), writefile)
+            except KeyError as error:
+                missing_reads([error.args[0]])
+            return
+
+    # Names are taken out of the set as their reads are found, so the names
+    # left at the end are of mapped reads missing from the raw data file
+    write_records(found_reads(raw_reads_by_name(infile1), names), writefile)
+    if names:
+        missing_reads(names)
+
+
+def found_reads(reads, names):
+    """
+    This function yields the reads whose names are in names, removing each
+    name from the set once its read has been found.
+    :params: reads -- An iterable of reads as 4-tuples of bytes objects.
+
+             names -- A set of read names.
+    :return: A generator of reads as 4-tuples of bytes objects.
+    """
+    for record in reads:
+        if record[0] in names:
+            names.discard(record[0])
+            yield record
+
+
+def missing_reads(names):
+    """
+    This function reports mapped reads that are not in the raw data file and
+    exits.
+    :param: names -- A collection of the names of the missing reads.
+    :return: none
+    """
+    print("{} mapped reads are not in the raw data file, e.g. {}".format(
+        len(names), next(iter(names)).decode("utf-8", "replace")))
+    exit(1)
+
+
+def sorted_runs(items, size, directory):
+    """
+    This function splits items into sorted runs of at most size items each,
+    written to files of tab-separated fields, one item per line.
+    :params: items -- An iterable of tuples of bytes objects without tabs or
+                      newlines.
+
+             size -- Number of items per run.
+
+             directory -- Directory to write the runs to.
+    :return: runs -- A list of the file names of the runs.
+    """
+    runs = []
+    items = iter(items)
+    while True:
+        run = [item for _, item in zip(range(size), items)]
+        if not run:
+            return runs
+        run.sort()
+        with tempfile.NamedTemporaryFile("wb", dir=directory,
+                                         delete=False) as runfile:
+            runfile.write(b"".join(b"\t".join(item) + b"\n" for item in run))
+        runs.append(runfile.name)
+
+
+def read_run(filename):
+    """
+    This function yields the items of a run written by sorted_runs.
+    """
+    with open(filename, "rb") as runfile:
+        for line in runfile:
+            yield tuple(line.rstrip(b"\n").split(b"\t"))
+
+
+def sort_merge_reads(args, infile1, names, writefile):
+    """
+    This function writes the raw reads whose names are in names using an
+    external sort-merge join: the names and the raw reads are each sorted by
+    name in runs of args.max_in_memory on disk, the runs are merged, and the
+    two sorted streams are walked through together. Memory use is bounded by
+    the run size whatever the size of the files.
+    :params: args -- An argparse object. Elements of the object can be accessed
+                     by their option name as attributes (e.g. args.gzip returns
+                     the user input for the gzip option)
+
+             infile1 -- A binary file object of raw reads to be read from.
+
+             names -- An iterable of the names of the mapped reads.
+
+             writefile -- A binary file object to be written to.
+    :return: none
+    """
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as directory:
+        name_runs = sorted_runs(((name,) for name in names),
+                                args.max_in_memory, directory)
+        read_runs = sorted_runs(raw_reads_by_name(infile1),
+                                args.max_in_memory, directory)
+        names = heapq.merge(*[read_run(run) for run in name_runs])
+        reads = heapq.merge(*[read_run(run) for run in read_runs])
+        write_records(merge_join(names, reads), writefile)
+
+
+def merge_join(names, reads):
+    """
+    This function yields the reads whose names appear in names, each once.
+    Both must be sorted by name.
+    :params: names -- An iterator of 1-tuples of read names.
+
+             reads -- An iterator of reads as 4-tuples of bytes objects.
+    :return: A generator of reads as 4-tuples of bytes objects. KeyError is
+             raised with the name of the first mapped read that is not in
+             reads.
+    """
+    name = next(names, None)
+    last = None  # Name of the last read written
+    for read in reads:
+        while name is not None and name[0] < read[0]:
+            if name[0] != last:
+                raise KeyError(name[0])
+            name = next(names, None)
+        if name is None:
+            return
+        if name[0] == read[0] and read[0] != last:
+            last = read[0]
+            yield read
+
+    while name is not None:
+        if name[0] != last:
+            raise KeyError(name[0])
+        name = next(names, None)
 
 
 if __name__ == "__main__":
     args = get_args()
     gzipped1, gzipped2, outfile = create_params(args)
     infile1, infile2, writefile = open_files(args, outfile, gzipped1, gzipped2)
-    reads = raw_reads_dictionary(infile1, gzipped1)
-    intersect_reads(args, reads, infile2, gzipped2, writefile)
+    if args.streaming:
+        stream_reads(args, infile1, infile2, writefile)
+    elif args.index:
+        try:
+            intersect_reads(infile1, mapped_read_names(infile2, args.sam),
+                            writefile)
+        except KeyError as error:
+            missing_reads([error.args[0]])
+    else:
+        reads = raw_reads_dictionary(infile1)
+        intersect_reads(reads, mapped_read_names(infile2, args.sam),
+                        writefile)
 
     infile1.close()
     infile2.close()
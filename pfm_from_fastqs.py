@@ -2,10 +2,46 @@
 """
 This program takes in fastq files and outputs a comma-separated values file 
 containing a Position Frequency Matrix (PFM) for reads of a given length.
+Reads are collapsed to unique sequences before counting; the collapsed tables
+can be saved and given in place of the fastq files in later runs. Bases are
+counted with numpy, a batch of reads at a time. N and other ambiguity codes are
+counted in their own column. PFMs for a whole range of read lengths, or for
+every length seen, can be made in a single pass over the input. Files can be
+processed in parallel, and the partial counts of each file saved so that they
+can be merged with new files later without processing them again. For a quick
+look, a sample of the reads can be counted instead, with confidence intervals
+on each base frequency, stopping once the intervals are narrow enough.
 """
 __author__ = "boseHere"
 import argparse
-import gzip
+import itertools
+import multiprocessing
+import operator
+import os
+import random
+import statistics
+
+import numpy as np
+
+import fastq_io
+
+# Names of the PFM columns
+COLUMNS = ["A", "C", "G", "T", "N"]
+
+# Column of the PFM for each byte value. Anything that is not A, C, G or T
+# (either case) goes in the N column.
+BASE_COLUMNS = np.full(256, COLUMNS.index("N"), dtype=np.int64)
+for column, bases in enumerate([b"Aa", b"Cc", b"Gg", b"Tt"]):
+    BASE_COLUMNS[list(bases)] = column
+
+# Number of unique sequences counted together in one numpy array
+BATCH_SIZE = 100000
+
+# Ending given to saved partial counts of a single file
+PARTIAL_SUFFIX = ".pfm.npz"
+
+# Number of sampled reads between checks of --precision
+CHECK_INTERVAL = 10000
 
 def get_args():
     """
@@ -19,8 +55,15 @@ def get_args():
             of each nucleotide base at each position in reads of a given \
                 length.")
     parser.add_argument("input", type=str, nargs="+", 
-                    help="Input fastq files. Input can be gzipped files")
-    parser.add_argument("seq_length", type=int, help="Length of reads")
+                    help="Input fastq files. Input can be gzipped files, \
+                    collapsed tables (.tsv or .tsv.gz) saved with \
+                    --collapsed_dir, or partial counts (.pfm.npz) saved with \
+                    --partial_dir")
+    parser.add_argument("seq_length", type=parse_lengths, help="Length of \
+        reads. Can also be a range of lengths (e.g. 18-26) or 'all' for every \
+        length seen, which makes one PFM per length from a single pass")
+    parser.add_argument("--combined", action="store_true", help="Write the \
+        PFMs of all lengths to a single file instead of one file per length")
     parser.add_argument("--progress", action="store_true", 
                     help="Print when a file has completed \
                     processing to the terminal. Helpful to use if inputting \
@@ -28,67 +71,483 @@ def get_args():
     parser.add_argument("--output_dir", type=str, nargs="?", const="./",
     default="./", help="Set output diretory for pfm text file. Default is \
         current directory")
+    parser.add_argument("--collapsed_dir", type=str, help="Directory to save \
+        the unique sequences and counts of each input file to")
+    parser.add_argument("--partial_dir", type=str, help="Directory to save \
+        the partial counts of each input fastq file to. They can be given as \
+        input in later runs to add them to the counts of new files")
+    parser.add_argument("--processes", type=int, default=1, help="Number of \
+        input files to process at the same time. Default is 1")
+    parser.add_argument("--threads", type=int, default=1, help="Number of \
+        threads to decompress gzipped input files with. Default is 1")
+    sampling = parser.add_argument_group("sampling", "Count a sample of the \
+        reads of each fastq file instead of all of them. Files are read one \
+        after another, and a _pfm_estimate.txt file is written with the \
+        frequency of each base and its confidence interval")
+    sampling.add_argument("--first", type=int, help="Only count the first N \
+        reads of each file")
+    sampling.add_argument("--every", type=int, help="Only count every k-th \
+        read of each file")
+    sampling.add_argument("--reservoir", type=int, help="Count a uniform \
+        random sample of N reads from each file")
+    sampling.add_argument("--seed", type=int, help="Random seed for \
+        --reservoir")
+    sampling.add_argument("--precision", type=float, help="Stop reading \
+        input once the confidence interval of every base frequency is at most \
+        this wide on either side (e.g. 0.01). Applies to all files together")
+    sampling.add_argument("--confidence", type=float, default=0.95, \
+        help="Confidence level of the intervals. Default is 0.95")
 
     args = parser.parse_args()
+    args.sampling = any(option is not None for option in
+                        [args.first, args.every, args.reservoir,
+                         args.precision])
+    for option in ["first", "every", "reservoir"]:
+        if getattr(args, option) is not None and getattr(args, option) < 1:
+            parser.error("--{} must be at least 1".format(option))
+    if args.precision is not None and args.reservoir is not None:
+        parser.error("--precision cannot be used with --reservoir, which \
+has to read every read")
+    if not 0 < args.confidence < 1:
+        parser.error("--confidence must be between 0 and 1")
 
     return args
 
+def parse_lengths(text):
+    """
+    This function reads the seq_length argument.
+    :param: text -- A single length, a range of lengths such as 18-26, or
+                    'all'.
+    :return: A tuple of the shortest and longest length to make PFMs for. The
+             longest length is None for 'all'.
+    """
+    if text == "all":
+        return 1, None
+    try:
+        lengths = [int(length) for length in text.split("-")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid length: " + text)
+    if len(lengths) == 1:
+        lengths *= 2
+    if len(lengths) != 2 or not 1 <= lengths[0] <= lengths[1]:
+        raise argparse.ArgumentTypeError("invalid length range: " + text)
+    return tuple(lengths)
+
+
+def grow_pfm(pfm, max_length):
+    """
+    This function makes room in a PFM tensor for reads up to a given length.
+    :params: pfm -- A numpy array of shape (n + 1, n, len(COLUMNS)).
+
+             max_length -- Length of the longest read to make room for.
+    :return: The same counts in an array of shape
+             (max_length + 1, max_length, len(COLUMNS)), or pfm itself if it
+             was big enough already.
+    """
+    grow = max_length - pfm.shape[1]
+    if grow <= 0:
+        return pfm
+    return np.pad(pfm, ((0, max_length + 1 - pfm.shape[0]), (0, grow), (0, 0)))
+
+
+def count_bases(pfm, seqs, weights):
+    """
+    This function adds the bases of a batch of reads to a PFM. The reads are
+    laid out as rows of a uint8 array, every base is turned into the index of
+    its position and column in the PFM, and the indexes are counted with a
+    single bincount.
+    :params: pfm -- A numpy array of shape (length, len(COLUMNS)) to add to.
+
+             seqs -- A list of sequences (as bytes), all as long as the PFM.
+
+             weights -- A list of the number of reads with each sequence.
+    :return: none
+    """
+    length = pfm.shape[0]
+    reads = np.frombuffer(b"".join(seqs), dtype=np.uint8).reshape(-1, length)
+    cells = BASE_COLUMNS[reads] + np.arange(length) * len(COLUMNS)
+    counts = np.bincount(cells.ravel(), np.repeat(weights, length),
+                         pfm.size)
+    pfm += np.rint(counts).astype(np.int64).reshape(pfm.shape)
+
+
+def batch_seq(pfm, batches, seq, n):
+    """
+    This function adds a sequence to the batch of its length, and counts the
+    batch once it is full.
+    :params: pfm -- A numpy array of counts, as made by file_pfm.
+
+             batches -- A dictionary where keys are read lengths and values
+                        are the (sequences, weights) lists of their batch.
+
+             seq -- The sequence (as bytes) to add.
+
+             n -- The number of reads with the sequence.
+    :return: pfm -- The array of counts, grown if needed.
+    """
+    length = len(seq)
+    if length not in batches:
+        batches[length] = ([], [])
+    seqs, weights = batches[length]
+    seqs.append(seq)
+    weights.append(n)
+    if len(seqs) == BATCH_SIZE:
+        pfm = grow_pfm(pfm, length)
+        count_bases(pfm[length, :length], seqs, weights)
+        batches[length] = ([], [])
+    return pfm
+
+
+def flush_batches(pfm, batches):
+    """
+    This function counts every batch that is not yet empty.
+    :params: pfm -- A numpy array of counts, as made by file_pfm.
+
+             batches -- A dictionary of batches, as used by batch_seq.
+    :return: pfm -- The array of counts, grown if needed.
+    """
+    for length, (seqs, weights) in batches.items():
+        if seqs:
+            pfm = grow_pfm(pfm, length)
+            count_bases(pfm[length, :length], seqs, weights)
+    batches.clear()
+    return pfm
+
+
+def in_range(args, seq):
+    min_length, max_length = args.seq_length
+    return min_length <= len(seq) and \
+        (max_length is None or len(seq) <= max_length)
+
+
+def empty_pfm(args):
+    max_length = args.seq_length[1]
+    pfm = np.zeros((0, 0, len(COLUMNS)), dtype=np.int64)
+    if max_length is not None:
+        pfm = grow_pfm(pfm, max_length)
+    return pfm
+
+
+def file_pfm(file, args):
+    """
+    This function creates the partial counts of a single input file, and saves
+    them if --partial_dir was given.
+    :params: file -- Name of a fastq file or of a collapsed table.
+
+             args -- An argparse object. Elements of the object can be accessed
+                     by their option name as attributes)
+    :return: pfm -- A numpy array of shape (n + 1, n, len(COLUMNS)), where n
+                    is the longest read length counted. pfm[length] is the
+                    Position Frequency Matrix of reads of that length, in its
+                    first length rows.
+    """
+    # Collapse the reads to unique sequences first, so each sequence is only
+    # counted once, weighted by the number of reads that have it
+    counts = fastq_io.load_collapsed(file, args.threads, args.collapsed_dir)
+    pfm = collapsed_pfm(counts, args)
+
+    if args.partial_dir is not None:
+        min_length, max_length = args.seq_length
+        np.savez(os.path.join(args.partial_dir,
+                              os.path.basename(file) + PARTIAL_SUFFIX),
+                 pfm=pfm, lengths=[min_length, max_length or 0])
+    return pfm
+
+
+def collapsed_pfm(counts, args):
+    """
+    This function creates the counts of a set of collapsed reads.
+    :params: counts -- A Counter where keys are sequences (as bytes) and
+                       values are the number of reads with that sequence.
+
+             args -- An argparse object. Elements of the object can be accessed
+                     by their option name as attributes)
+    :return: pfm -- A numpy array of counts, as made by file_pfm.
+    """
+    pfm = empty_pfm(args)
+    batches = {}
+    for seq, n in counts.items():
+        if in_range(args, seq):
+            pfm = batch_seq(pfm, batches, seq, n)
+    return flush_batches(pfm, batches)
+
+
+def file_pfm_worker(job):
+    file, args = job
+    return file, file_pfm(file, args)
+
+
+def load_partial(file, args):
+    """
+    This function reads partial counts saved with --partial_dir, keeping only
+    the read lengths that were asked for. The saved counts must cover all of
+    those lengths.
+    :params: file -- Name of the saved partial counts.
+
+             args -- An argparse object. Elements of the object can be accessed
+                     by their option name as attributes)
+    :return: pfm -- A numpy array of partial counts, as made by file_pfm.
+    """
+    min_length, max_length = args.seq_length
+    with np.load(file) as data:
+        pfm = data["pfm"]
+        saved_min, saved_max = data["lengths"].tolist()
+    if saved_min > min_length or (saved_max and
+                                  (max_length is None or
+                                   max_length > saved_max)):
+        print("{} only has counts for read lengths {}-{}".format(
+            file, saved_min, saved_max or "all"))
+        exit(1)
+
+    pfm = pfm.copy()
+    pfm[:min_length] = 0
+    if max_length is not None:
+        pfm = grow_pfm(pfm, max_length)[:max_length + 1, :max_length]
+    return pfm
+
+
+def merge_pfm(pfm, other):
+    """
+    This function adds two sets of counts together.
+    :params: pfm, other -- numpy arrays of counts, as made by file_pfm.
+    :return: A numpy array of the summed counts, big enough for both.
+    """
+    pfm = grow_pfm(pfm, other.shape[1])
+    other = grow_pfm(other, pfm.shape[1])
+    return pfm + other
+
+
 def make_pfm(args):
     """
-    This function iterates through the given files to create a list of lists
-    containing the nucleotide base count at each position.
+    This function creates the counts of each given file, on a pool of worker
+    processes with --processes, and merges them into a single numpy array
+    containing the nucleotide base count at each position, for every read
+    length in the requested range.
     :param: args -- An argparse object. Elements of the object can be accessed
                      by their option name as attributes)
-    :return: pfm -- A list of lists containing a Position Frequency Matrix.
+    :return: pfm -- A numpy array of shape (n + 1, n, len(COLUMNS)), as made by
+                    file_pfm.
     """
-    pfm = [[0] * 4 for _ in range(args.seq_length)]
+    pfm = empty_pfm(args)
+
+    # Saved partial counts are merged straight away; only the other files are
+    # processed
+    jobs = []
     for file in args.input:
-        if file.endswith(".gz"):
-            ofile = gzip.open(file, "r")
+        if file.endswith(PARTIAL_SUFFIX):
+            pfm = merge_pfm(pfm, load_partial(file, args))
         else:
-            ofile = open(file, "r")
-        i = 0
-        for line in ofile:
-            if file.endswith(".gz"):
-                line = line.decode("utf-8")
-            line = line.strip()
-            if i == 1 and len(line) == args.seq_length:
-                for j in range(len(line)):
-                    if line[j] == "A":
-                        pfm[j][0] += 1
-                    elif line[j] == "C":
-                        pfm[j][1] += 1
-                    elif line[j] == "G":
-                        pfm[j][2] += 1
-                    elif line[j] == "T":
-                        pfm[j][3] += 1
-            i += 1
-            if i == 4:
-                 i = 0
+            jobs.append((file, args))
+
+    processes = min(args.processes, len(jobs))
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(file_pfm_worker, jobs)
+    else:
+        pool = None
+        results = map(file_pfm_worker, jobs)
 
+    for file, partial in results:
+        pfm = merge_pfm(pfm, partial)
         if args.progress:
-            print("{} finished processing".format(file)
-    
+            print("{} finished processing".format(file))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return pfm
+
+def sample_reads(file, args, rng):
+    """
+    This function yields the sequences of the sampled reads of a fastq file.
+    :params: file -- Name of the fastq file.
+
+             args -- An argparse object. Elements of the object can be accessed
+                     by their option name as attributes)
+
+             rng -- A random.Random object for --reservoir.
+    :return: A generator of sequences (as bytes).
+    """
+    with fastq_io.open_input(file, args.threads) as infile:
+        records = fastq_io.read_records(infile)
+        if args.every is not None:
+            records = itertools.islice(records, 0, None, args.every)
+        if args.first is not None:
+            records = itertools.islice(records, args.first)
+        seqs = map(operator.itemgetter(1), records)
+        if args.reservoir is None:
+            yield from seqs
+            return
+
+        # Algorithm R: the i-th read replaces a random member of the
+        # reservoir with probability size / i
+        reservoir = list(itertools.islice(seqs, args.reservoir))
+        for i, seq in enumerate(seqs, args.reservoir + 1):
+            j = rng.randrange(i)
+            if j < args.reservoir:
+                reservoir[j] = seq
+    yield from reservoir
+
+
+def interval(pfm, z):
+    """
+    This function gives the Wilson score interval of every base frequency.
+    :params: pfm -- A numpy array of counts, as made by file_pfm.
+
+             z -- Number of standard deviations for the confidence level.
+    :return: frequency, lower, upper -- numpy arrays of the same shape as pfm.
+                                        Cells of read lengths with no reads
+                                        are 0 with an interval of 0 to 1.
+    """
+    reads = pfm.sum(axis=2, keepdims=True)
+    n = np.maximum(reads, 1)
+    frequency = pfm / n
+    centre = (frequency + z * z / (2 * n)) / (1 + z * z / n)
+    half = z * np.sqrt(frequency * (1 - frequency) / n + z * z / (4 * n * n)) \
+        / (1 + z * z / n)
+    lower = np.where(reads > 0, np.clip(centre - half, 0, 1), 0)
+    upper = np.where(reads > 0, np.clip(centre + half, 0, 1), 1)
+    return frequency, lower, upper
+
+
+def max_half_width(args, pfm, z):
+    """
+    This function gives the widest confidence interval, on either side of its
+    estimate, among the cells that will be written out. Read lengths with no
+    sampled reads at all are left out.
+    """
+    lengths = [length for length in output_lengths(args, pfm)
+               if length < pfm.shape[0] and pfm[length].any()]
+    if not lengths:
+        return 1
+    frequency, lower, upper = interval(pfm, z)
+    return max(np.max(np.maximum(frequency - lower, upper - frequency)
+                      [length, :length]) for length in lengths)
+
+
+def sample_pfm(args):
+    """
+    This function counts a sample of the reads of the given files. With
+    --precision, reading stops as soon as every interval is narrow enough.
+    :param: args -- An argparse object. Elements of the object can be accessed
+                     by their option name as attributes)
+    :return: pfm -- A numpy array of counts, as made by file_pfm.
+    """
+    z = statistics.NormalDist().inv_cdf(0.5 + args.confidence / 2)
+    rng = random.Random(args.seed)
+    pfm = empty_pfm(args)
+    batches = {}
+    sampled = 0
+    for file in args.input:
+        for seq in sample_reads(file, args, rng):
+            sampled += 1
+            if in_range(args, seq):
+                pfm = batch_seq(pfm, batches, seq, 1)
+            if args.precision is not None and sampled % CHECK_INTERVAL == 0:
+                pfm = flush_batches(pfm, batches)
+                if max_half_width(args, pfm, z) <= args.precision:
+                    break
+        else:
+            if args.progress:
+                print("{} finished processing".format(file))
+            continue
+        break
+
+    pfm = flush_batches(pfm, batches)
+    print("Counted {} sampled reads; widest {:.0%} confidence interval is "
+          "+/- {:.4f}".format(sampled, args.confidence,
+                              max_half_width(args, pfm, z)))
     return pfm
 
+
+def output_lengths(args, pfm):
+    """
+    This function lists the read lengths to write PFMs for: every length in
+    the requested range, or every length seen for 'all'.
+    """
+    min_length, max_length = args.seq_length
+    if max_length is not None:
+        return list(range(min_length, max_length + 1))
+    return [length for length in range(1, pfm.shape[0])
+            if pfm[length].any()]
+
+
+def write_tables(args, pfm, suffix, header, rows):
+    """
+    This function writes a table for each read length to its own
+    comma-separated text output file, or with --combined all of them to a
+    single file with an extra Length column.
+    :params: args -- An argparse object. Elements of the object can be accessed
+                     by their option name as attributes)
+
+             pfm -- A numpy array of counts, as made by file_pfm.
+
+             suffix -- Ending of the output file names.
+
+             header -- Column names of the table.
+
+             rows -- A function giving the rows of the table for a read length.
+    """
+    lengths = output_lengths(args, pfm)
+    if args.combined:
+        min_length, max_length = args.seq_length
+        name = "all" if max_length is None else \
+            "{}-{}".format(min_length, max_length)
+        with open(args.output_dir + name + suffix, "w+") as fo:
+            fo.write("Length, " + header + "\n")
+            for length in lengths:
+                for row in rows(length):
+                    fo.write(str(length) + ", " + ", ".join(map(str, row)) +
+                             "\n")
+        return
+
+    for length in lengths:
+        with open(args.output_dir + str(length) + suffix, "w+") as fo:
+            fo.write(header + "\n")
+            for row in rows(length):
+                fo.write(", ".join(map(str, row)) + "\n")
+
+
 def write_pfm(args, pfm):
     """
-    This function writes the PFM to a comma-sepearated text output file. 
+    This function writes the PFM of each read length to a comma-separated text
+    output file.
     """
-    with open(args.output_dir + str(args.seq_length) + "_pfm.txt", "w+") as fo:
-        fo.write("Position, A, C, G, T")
-        for i in range(len(pfm)):
-            for j in range(len(pfm[i])):
-                pfm[i][j] = str(pfm[i][j])
-        i = 0
-        for row in pfm:
-            fo.write(str(i) + ", " + ", ".join(row) + "\n")
-            i += 1
+    def rows(length):
+        return [[i] + row for i, row in enumerate(pfm[length, :length].tolist())]
+
+    write_tables(args, pfm, "_pfm.txt", "Position, " + ", ".join(COLUMNS),
+                 rows)
+
+
+def write_estimates(args, pfm):
+    """
+    This function writes the estimated frequency of each base at each position,
+    with its confidence interval, to a comma-separated text output file.
+    """
+    z = statistics.NormalDist().inv_cdf(0.5 + args.confidence / 2)
+    frequency, lower, upper = interval(pfm, z)
+
+    def rows(length):
+        for i in range(length):
+            for j, base in enumerate(COLUMNS):
+                yield [i, base, pfm[length, i, j],
+                       "{:.4f}".format(frequency[length, i, j]),
+                       "{:.4f}".format(lower[length, i, j]),
+                       "{:.4f}".format(upper[length, i, j])]
+
+    write_tables(args, pfm, "_pfm_estimate.txt",
+                 "Position, Base, Count, Frequency, Lower, Upper", rows)
 
 def main():
     args = get_args()
-    pfm = make_pfm(args)
-    write_pfm(args, pfm)
+    if args.sampling:
+        pfm = sample_pfm(args)
+        write_pfm(args, pfm)
+        write_estimates(args, pfm)
+    else:
+        pfm = make_pfm(args)
+        write_pfm(args, pfm)
     
 
 if __name__ == "__main__":
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+This program runs the usual preprocessing steps on a fastq file in a single
+pass: filtering reads by length (as trim_a_range does), cutting reads down to
+a target length (as remove-error-reads does), converting to fasta (as
+fastq-to-a does), and counting miRNAs (as count_mirnas does) and bases at each
+position (as pfm_from_fastqs does). The input is decompressed and parsed once
+and each read goes through every step in turn, so nothing is written to disk
+between steps unless asked for with --fastq_out or --fasta_out.
+"""
+__author__ = "boseHere"
+import argparse
+import collections
+import operator
+
+import bgzf
+import count_mirnas
+import fastq_io
+import pfm_from_fastqs
+import trim_a_range
+
+# Number of reads to hold in memory before writing them to an output file
+WRITE_BATCH = 10000
+
+
+def get_args():
+    """
+    This function uses the argparse library to parse command line arguments.
+    :param: none
+    :return: args -- An argparse object. Elements of the object can be accessed
+                     by their option name as attributes (e.g. args.min_length
+                     returns the user input for the min_length option)
+    """
+    parser = argparse.ArgumentParser(description="Filters, trims and converts "
+                                                 "the reads of a fastq file "
+                                                 "and counts miRNAs and bases "
+                                                 "in a single pass")
+    parser.add_argument("input", type=str, help="Input fastq file name. Can be "
+                                                "gzipped")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Number of threads to decompress gzipped input "
+                             "and compress gzipped output with. Set to 1 by "
+                             "default")
+
+    steps = parser.add_argument_group("steps", "Steps run on each read, in "
+                                               "this order. Steps that are "
+                                               "not asked for are skipped")
+    steps.add_argument("--min_length", type=int, default=0,
+                       help="Shortest read length to keep. Set to 0 by "
+                            "default")
+    steps.add_argument("--max_length", type=int,
+                       help="Longest read length to keep")
+    steps.add_argument("--target_length", type=int,
+                       help="Cut the sequence and quality of longer reads "
+                            "down to this length")
+    steps.add_argument("--fastq_out", type=str,
+                       help="Write the filtered and trimmed reads to this "
+                            "fastq file. Gzipped (BGZF) if it ends in .gz")
+    steps.add_argument("--fasta_out", type=str,
+                       help="Write the filtered and trimmed reads to this "
+                            "fasta file. Gzipped (BGZF) if it ends in .gz")
+    steps.add_argument("--compression_level", type=int, default=6,
+                       help="Gzip compression level of gzipped output files, "
+                            "from 0 (fastest) to 9 (smallest). Set to 6 by "
+                            "default")
+
+    mirnas = parser.add_argument_group("miRNA counting", "Count the reads "
+                                                         "matching each miRNA "
+                                                         "and print the "
+                                                         "counts, as "
+                                                         "count_mirnas does")
+    mirnas.add_argument("--mirnas", type=str,
+                        help="Gzipped miRNA reference fasta file")
+    mirnas.add_argument("--mismatches", type=int, default=0, choices=[0, 1, 2],
+                        help="Number of mismatches allowed between a read and "
+                             "a miRNA")
+    for option, help_text in [("trim_5p", "Number of bases a read may be "
+                                          "missing from the 5' end of a "
+                                          "miRNA"),
+                              ("trim_3p", "Number of bases a read may be "
+                                          "missing from the 3' end of a "
+                                          "miRNA"),
+                              ("add_5p", "Number of extra bases a read may "
+                                         "have before the 5' end of a miRNA"),
+                              ("add_3p", "Number of extra bases a read may "
+                                         "have after the 3' end of a miRNA")]:
+        mirnas.add_argument("--" + option, type=int, default=0, help=help_text)
+
+    pfm = parser.add_argument_group("PFM", "Count the bases at each position "
+                                           "of the reads, as pfm_from_fastqs "
+                                           "does")
+    pfm.add_argument("--pfm", dest="seq_length",
+                     type=pfm_from_fastqs.parse_lengths,
+                     help="Length of reads to make a PFM for. Can also be a "
+                          "range of lengths (e.g. 18-26) or 'all'")
+    pfm.add_argument("--combined", action="store_true",
+                     help="Write the PFMs of all lengths to a single file")
+    pfm.add_argument("--output_dir", type=str, default="./",
+                     help="Directory for the PFM files. Set to current "
+                          "directory by default")
+
+    args = parser.parse_args()
+    if args.min_length < 0:
+        parser.error("--min_length must be 0 or more")
+    if args.max_length is not None and args.max_length < args.min_length:
+        parser.error("--max_length must be at least --min_length")
+    if args.target_length is not None and args.target_length < 1:
+        parser.error("--target_length must be at least 1")
+    if not 0 <= args.compression_level <= 9:
+        parser.error("--compression_level must be between 0 and 9")
+    for option in ["trim_5p", "trim_3p", "add_5p", "add_3p"]:
+        if getattr(args, option) < 0:
+            parser.error("--{} must be 0 or more".format(option))
+    return args
+
+
+def open_output(args, filename):
+    """
+    This function opens an output file for binary writing.
+    :params: args -- An argparse object. Elements of the object can be accessed
+                     by their option name as attributes
+
+             filename -- Name of the file. Written as BGZF if it ends in .gz.
+    :return: A binary file object to be written to.
+    """
+    if filename.endswith(".gz"):
+        return bgzf.BgzfWriter(filename, args.compression_level, args.threads)
+    return open(filename, "wb")
+
+
+def write_stage(records, writefile, formatter):
+    """
+    This function writes every read to a file as it passes on to the next
+    step, in large chunks.
+    :params: records -- An iterable of reads as 4-tuples of bytes objects.
+
+             writefile -- A binary file object to be written to.
+
+             formatter -- A function turning a read into the bytes to write.
+    :return: A generator of the same reads.
+    """
+    buffer = []
+    for record in records:
+        buffer.append(formatter(record))
+        if len(buffer) >= WRITE_BATCH:
+            writefile.write(b"".join(buffer))
+            buffer = []
+        yield record
+
+    writefile.write(b"".join(buffer))
+
+
+def trim_stage(records, target):
+    """
+    This function cuts every read down to a target length.
+    :params: records -- An iterable of reads as 4-tuples of bytes objects.
+
+             target -- Longest length to keep.
+    :return: A generator of reads as 4-tuples of bytes objects.
+    """
+    for record in records:
+        yield fastq_io.trim_record(record, target)
+
+
+def build_stages(args, infile, outputs):
+    """
+    This function chains the requested steps onto the reads of the input file.
+    Nothing is read until the last step is iterated over.
+    :params: args -- An argparse object. Elements of the object can be accessed
+                     by their option name as attributes
+
+             infile -- A binary file object to be read from.
+
+             outputs -- A list that the files opened for --fastq_out and
+                        --fasta_out are added to, to be closed by the caller.
+    :return: A generator of reads as 4-tuples of bytes objects, after every
+             step.
+    """
+    records = fastq_io.read_records(infile)
+    if args.min_length or args.max_length:
+        records = trim_a_range.filter_lengths(records, args.min_length,
+                                              args.max_length)
+    if args.target_length is not None:
+        records = trim_stage(records, args.target_length)
+    if args.fastq_out is not None:
+        outputs.append(open_output(args, args.fastq_out))
+        records = write_stage(records, outputs[-1], fastq_io.format_record)
+    if args.fasta_out is not None:
+        outputs.append(open_output(args, args.fasta_out))
+        records = write_stage(records, outputs[-1], fastq_io.format_fasta)
+    return records
+
+
+def run(args):
+    """
+    This function reads the input file once, running every read through the
+    requested steps. If miRNAs or bases are to be counted, the reads that come
+    out of the last step are collapsed to unique sequences and both counts are
+    made from those.
+    :param: args -- An argparse object. Elements of the object can be accessed
+                    by their option name as attributes
+    :return: collapsed -- A Counter where keys are sequences (as bytes) and
+                          values are the number of reads with that sequence,
+                          or None if nothing is to be counted.
+    """
+    outputs = []
+    try:
+        infile = fastq_io.open_input(args.input, args.threads)
+    except FileNotFoundError:
+        print("Input file does not exist")
+        exit(1)
+    try:
+        with infile:
+            records = build_stages(args, infile, outputs)
+            if args.mirnas is None and args.seq_length is None:
+                collections.deque(records, maxlen=0)
+                return None
+            collapsed = collections.Counter()
+            collapsed.update(map(operator.itemgetter(1), records))
+            return collapsed
+    except FileNotFoundError:
+        print("Output directory does not exist")
+        exit(1)
+    finally:
+        for writefile in outputs:
+            writefile.close()
+
+
+def count(args, collapsed):
+    """
+    This function counts the reads matching each miRNA and prints the counts
+    in the same format as count_mirnas.
+    :params: args -- An argparse object. Elements of the object can be accessed
+                     by their option name as attributes
+
+             collapsed -- A Counter of sequences as made by run.
+    :return: none
+    """
+    d = vars(args).copy()
+    d["miRNA file"] = [args.mirnas]
+    mirna_dict = count_mirnas.make_mirna_dict(d)
+    counts = count_mirnas.count_collapsed(collapsed,
+                                          count_mirnas.Matcher(mirna_dict, d))
+    for entry, n in zip(mirna_dict.values(), counts):
+        entry[1] += n
+    count_mirnas.output(mirna_dict)
+
+
+def main():
+    args = get_args()
+    collapsed = run(args)
+    if args.mirnas is not None:
+        count(args, collapsed)
+    if args.seq_length is not None:
+        pfm_from_fastqs.write_pfm(args,
+                                  pfm_from_fastqs.collapsed_pfm(collapsed,
+                                                                args))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,23 @@
 Author: Maya Bose
 Date: 5/20/19
 This program removes the last base of error-prone full-length reads from a
-fastq file.
+fastq file. Output goes to stdout, or straight to a file (gzipped as BGZF if
+its name ends in .gz). With --processes, the input is split into chunks of
+whole reads that are trimmed in parallel and written back in order.
 '''
 
 
 import argparse
-import gzip
+import collections
+import io
+import multiprocessing
+import sys
+
+import bgzf
+import fastq_io
+
+# Number of reads to hold in memory before writing them to stdout
+WRITE_BATCH = 10000
 
 
 def main():
@@ -25,29 +36,76 @@ def get_args():
                         help='The RNA seq filename')
     parser.add_argument('Target length', metavar='l', type=int, nargs=1, help=
                         'Target length of a read')
+    parser.add_argument('--output', type=str, help='Write the reads to this\
+    file instead of stdout. Gzipped (BGZF) if it ends in .gz')
+    parser.add_argument('--compression_level', type=int, default=6,
+                        choices=range(10), metavar='{0-9}', help='Gzip\
+    compression level of the output file')
+    parser.add_argument('--threads', type=int, default=1, help='Number of\
+    threads to decompress the RNA file and compress the output file with')
+    parser.add_argument('--processes', type=int, default=1, help='Number of\
+    processes to trim reads with')
     args = parser.parse_args()
     d = vars(args)
     return d
 
 
+def trim_chunk(job):
+    # Trim every read in a chunk of whole reads and give back the fastq text
+    chunk, target = job
+    return b''.join([fastq_io.format_record(fastq_io.trim_record(record,
+                                                                 target))
+                     for record in fastq_io.read_records(io.BytesIO(chunk))])
+
+
+def open_output(d):
+    if d['output'] is None:
+        return sys.stdout.buffer
+    if d['output'].endswith('.gz'):
+        return bgzf.BgzfWriter(d['output'], d['compression_level'],
+                               d['threads'])
+    return open(d['output'], 'wb')
+
+
 def strip_error_bases(d):
-    with gzip.open(d['RNA file'][0], 'r') as rfile:
-        i = 0
-        for line in rfile:
-            line = line.decode('utf-8')
-            line = line.rstrip('\n')
-            if i == 1 or i == 3:
+    target = d['Target length'][0]
+    try:
+        out = open_output(d)
+    except FileNotFoundError:
+        print('Output directory does not exist')
+        exit(1)
+    with fastq_io.open_input(d['RNA file'][0], d['threads']) as rfile:
+        if d['processes'] > 1:
+            strip_chunks(rfile, out, target, d['processes'])
+        else:
+            buffer = []
+            for record in fastq_io.read_records(rfile):
 
                 # Reduce over-read lines to target length
-                if len(line) > d['Target length'][0]:
-                    trim = len(line) - d['Target length'][0]
-                    if trim > 0:
-                        line = line[:-1 * trim]
+                record = fastq_io.trim_record(record, target)
+
+                buffer.append(fastq_io.format_record(record))
+                if len(buffer) >= WRITE_BATCH:
+                    out.write(b''.join(buffer))
+                    buffer = []
+            out.write(b''.join(buffer))
+    if out is not sys.stdout.buffer:
+        out.close()
+
 
-            print(line)
-            i += 1
-            if i == 4:
-                i = 0
+def strip_chunks(rfile, out, target, processes):
+    # Hand chunks of whole reads to a pool of processes, writing the results
+    # in input order. Only a few chunks per process are in flight at a time,
+    # so memory use does not grow with the size of the input.
+    with multiprocessing.Pool(processes) as pool:
+        pending = collections.deque()
+        for chunk in fastq_io.read_chunks(rfile):
+            pending.append(pool.apply_async(trim_chunk, ((chunk, target),)))
+            if len(pending) > 2 * processes:
+                out.write(pending.popleft().get())
+        while pending:
+            out.write(pending.popleft().get())
 
 
-main()
+if __name__ == '__main__':
+    main()
@@ -4,16 +4,52 @@ Author: Maya Bose
 Date: 5/17/19
 This program takes the name of a chromosome, the index of the start base, and
 the index of the end base, and outputs the bases within the given base range.
+Uncompressed and BGZF compressed fasta files are indexed (.fai, and .gzi for
+BGZF) on first use so that later lookups read only the requested bases. With
+--bgzip, a genome is first recompressed to BGZF, and with --twobit it is
+converted to a .2bit file that packs four bases per byte. .2bit files are
+memory-mapped and only the requested bases are decoded. With --bed, every
+region in a BED file is written out in fasta format from a single pass over the
+genome.
 '''
 
 import argparse
+import collections
 import gzip
+import sys
+
+import bgzf
+import faidx
+import fastq_io
+import twobit
+
+# A region from a BED file. start and end count from 0, end not included.
+Region = collections.namedtuple('Region', ['chrom', 'start', 'end', 'name',
+                                           'strand'])
+
+# Complement of each base, including the IUPAC ambiguity codes
+COMPLEMENT = bytes.maketrans(b'ACGTURYKMBVDHNacgturykmbvdhn',
+                             b'TGCAAYRMKVBHDNtgcaayrmkvbhdn')
+
+# Number of regions to hold in memory before writing them to stdout
+WRITE_BATCH = 1000
 
 
 def main():
     d = get_args()
-    chr = retrieve_scaffold(d)
-    print_seq(chr, d)
+    if d['bgzip']:
+        bgzip_genome(d)
+    if d['twobit']:
+        twobit_genome(d)
+    if d['bed']:
+        print_regions(d)
+    elif d['End'] is None:
+        return
+    elif is_indexable(d['Filename'][0]):
+        print_indexed_seq(d)
+    else:
+        chr = retrieve_scaffold(d)
+        print_seq(chr, d)
 
 
 def get_args():
@@ -22,22 +58,92 @@ def get_args():
                                                  "coordinates")
     parser.add_argument('Filename', metavar='f', type=str, nargs=1,
                         help='a fasta file')
-    parser.add_argument('Chromosome name', metavar='n', type=str, nargs=1,
+    parser.add_argument('Chromosome name', metavar='n', type=str, nargs='?',
                         help='The name of the chromosome/scaffold where the'
                              'sequence is')
-    parser.add_argument('Start', metavar='s', type=int, nargs=1, help='The\
+    parser.add_argument('Start', metavar='s', type=int, nargs='?', help='The\
 number of the base where the sequence starts.')
-    parser.add_argument('End', metavar='e', type=int, nargs=1, help='The\
+    parser.add_argument('End', metavar='e', type=int, nargs='?', help='The\
     number of the base where the sequence starts.')
+    parser.add_argument('--bed', type=str, help='A BED file of regions to '
+                        'retrieve instead of a single chromosome and range. '
+                        'Regions on the - strand (6th column) are reverse '
+                        'complemented')
+    parser.add_argument('--bgzip', type=str, help='Recompress the fasta file '
+                        'to this BGZF file and index it, then retrieve '
+                        'sequences from the BGZF file. Later runs can be given '
+                        'the BGZF file directly')
+    parser.add_argument('--twobit', type=str, help='Convert the fasta file to '
+                        'this .2bit file, then retrieve sequences from the '
+                        '.2bit file. Later runs can be given the .2bit file '
+                        'directly')
     args = parser.parse_args()
     d = vars(args)
 
+    if d['bed'] is None and d['End'] is None and d['bgzip'] is None and \
+            d['twobit'] is None:
+        parser.error('a chromosome name, start and end are required unless '
+                     '--bed, --bgzip or --twobit is given')
+
     return d
 
 
+def is_indexable(filename):
+    # Uncompressed, BGZF compressed and .2bit files can be read through an
+    # index; other gzipped files have to be read from the start
+    try:
+        return not filename.endswith('.gz') or bgzf.is_bgzf(filename)
+    except FileNotFoundError:
+        print("Fasta file does not exist")
+        exit(1)
+
+
+def open_genome(filename):
+    if filename.endswith('.2bit'):
+        return twobit.TwoBitFile(filename)
+    return faidx.FastaFile(filename)
+
+
+def bgzip_genome(d):
+    # Recompress the genome to BGZF and build its .fai and .gzi indexes, then
+    # use the BGZF file for any lookups
+    try:
+        with fastq_io.open_input(d['Filename'][0]) as infile, \
+                bgzf.BgzfWriter(d['bgzip']) as outfile:
+            for chunk in iter(lambda: infile.read(fastq_io.BLOCK_SIZE), b''):
+                outfile.write(chunk)
+    except FileNotFoundError:
+        print("Fasta file or output directory does not exist")
+        exit(1)
+    bgzf.build_gzi(d['bgzip'])
+    faidx.build_index(d['bgzip'])
+    d['Filename'] = [d['bgzip']]
+
+
+def twobit_genome(d):
+    # Convert the genome to a .2bit file, then use it for any lookups
+    try:
+        twobit.write_twobit(d['Filename'][0], d['twobit'])
+    except FileNotFoundError:
+        print("Fasta file or output directory does not exist")
+        exit(1)
+    d['Filename'] = [d['twobit']]
+
+
 def retrieve_scaffold(d):
-    with gzip.open(d['Filename'][0]) as the_file:
-        k = False
+    for name, data in retrieve_scaffolds(d['Filename'][0],
+                                         {d['Chromosome name']}):
+        return data
+    return []
+
+
+def retrieve_scaffolds(filename, names):
+    # Read through the gzipped fasta file once, yielding the name and lines of
+    # nucleotides of each wanted chromosome in the order they are found. Stop
+    # reading once every wanted chromosome has been found.
+    names = set(names)
+    with gzip.open(filename) as the_file:
+        name = None
         data = []
         for line in the_file:
 
@@ -45,27 +151,132 @@ def retrieve_scaffold(d):
             line = line.strip()
             line = line.decode('utf-8')
 
-            # Find the chromosome name within the file
-            if line[1:] == d['Chromosome name'][0]:
-                k = True
+            if line.startswith(">"):
+                if name is not None:
+                    yield name, data
+                    if not names:
+                        return
+                name = None
+                data = []
 
-            elif k:  # If the chromosome name has been found, start appending
-                # the lines of nucleotides for that chromosome until the next
-                # chromosome is found. Break the loop when the next chromosome
-                # is reached
-                if line.startswith(">"):
-                    break
-                else:
-                    data.append(line)
+                # Find the chromosome name within the file, either as the
+                # whole header or as the header up to the first whitespace
+                header = line[1:]
+                if header not in names and header:
+                    header = header.split()[0]
+                if header in names:
+                    name = header
+                    names.discard(name)
 
-        return data
+            elif name is not None:  # If the chromosome name has been found,
+                # append the lines of nucleotides for that chromosome until
+                # the next chromosome is found
+                data.append(line)
+
+        if name is not None:
+            yield name, data
 
 
 def print_seq(chr, d):
     full_chr = "".join(chr)
-    for i in range(d['Start'][0], d['End'][0] + 1):
-        print(full_chr[i], end="")
-    print()
+    print(full_chr[d['Start']:d['End'] + 1])
+
+
+def print_indexed_seq(d):
+    # Look up the base range through the .fai index of the fasta file, or the
+    # index of the .2bit file, so only the bytes holding those bases are read
+    try:
+        with open_genome(d['Filename'][0]) as fasta:
+            seq = fasta.fetch(d['Chromosome name'], d['Start'], d['End'] + 1)
+    except FileNotFoundError:
+        print("Fasta file does not exist")
+        exit(1)
+    except (faidx.FaidxError, twobit.TwoBitError) as error:
+        print(error)
+        exit(1)
+    sys.stdout.buffer.write(seq + b'\n')
+
+
+def read_regions(filename):
+    # Read the regions of a BED file, skipping header and comment lines. The
+    # name (4th column) and strand (6th column) are optional.
+    regions = []
+    with open(filename) as bed:
+        for line in bed:
+            fields = line.rstrip('\r\n').split('\t')
+            if not fields[0] or fields[0].startswith(('#', 'track',
+                                                       'browser')):
+                continue
+            name = fields[3] if len(fields) > 3 and fields[3] != '.' else None
+            strand = fields[5] if len(fields) > 5 else '.'
+            regions.append(Region(fields[0], int(fields[1]), int(fields[2]),
+                                  name, strand))
+    return regions
+
+
+def region_order(region):
+    return region.start, region.end
+
+
+def format_region(region, seq):
+    # Make the fasta entry for one region, reverse complementing the bases of
+    # regions on the - strand
+    if region.strand == '-':
+        seq = seq.translate(COMPLEMENT)[::-1]
+    header = '>{}:{}-{}'.format(region.chrom, region.start, region.end)
+    if region.strand in ('+', '-'):
+        header += '(' + region.strand + ')'
+    if region.name is not None:
+        header = '>' + region.name + '::' + header[1:]
+    return header.encode('utf-8') + b'\n' + seq + b'\n'
+
+
+def print_regions(d):
+    # Sort the regions by chromosome and start, then pull them all out of the
+    # genome in one sweep: through the index of uncompressed, BGZF and .2bit
+    # files, or a single read of the file for other gzipped ones
+    try:
+        regions = read_regions(d['bed'])
+    except FileNotFoundError:
+        print("BED file does not exist")
+        exit(1)
+    by_chrom = collections.defaultdict(list)
+    for region in regions:
+        by_chrom[region.chrom].append(region)
+
+    out = sys.stdout.buffer
+    buffer = []
+    try:
+        if not is_indexable(d['Filename'][0]):
+            scaffolds = retrieve_scaffolds(d['Filename'][0], by_chrom)
+            for name, chr in scaffolds:
+                full_chr = "".join(chr).encode('utf-8')
+                for region in sorted(by_chrom.pop(name), key=region_order):
+                    buffer.append(format_region(
+                        region, full_chr[region.start:region.end]))
+                out.write(b''.join(buffer))
+                buffer = []
+        else:
+            with open_genome(d['Filename'][0]) as fasta:
+                for name in list(fasta.index):
+                    for region in sorted(by_chrom.pop(name, []),
+                                         key=region_order):
+                        buffer.append(format_region(
+                            region, fasta.fetch(name, region.start,
+                                                region.end)))
+                        if len(buffer) >= WRITE_BATCH:
+                            out.write(b''.join(buffer))
+                            buffer = []
+                out.write(b''.join(buffer))
+    except FileNotFoundError:
+        print("Fasta file does not exist")
+        exit(1)
+    except (faidx.FaidxError, twobit.TwoBitError) as error:
+        print(error)
+        exit(1)
+
+    for name in by_chrom:
+        print("Chromosome/scaffold {} not found".format(name), file=sys.stderr)
 
 
 main()
@@ -5,13 +5,71 @@ Date: 9/3/2019
 Purpose: This program takes an NCBI Taxonomy ID and produces a fasta file 
 containing all non-miRNA reads for that species available from the Rfam 
 database: https://rfam.xfam.org/
+Several IDs can be given at once. They are looked up in a single query, each
+family file is read once, and each read is sent to the output file of its
+species.
+Family fasta files are downloaded over several FTP connections at once and
+decompressed and filtered as the data arrives, then written out in order of
+accession number. With --cache_dir, downloaded family files are kept on disk
+and only downloaded again when their size or modification time on the server
+changes, and --offline builds the output from the cache alone.
+With --build_mirror, the columns of the Rfam tables used here are loaded from
+the Rfam table dumps into an indexed SQLite file, and with --mirror the query
+is run against that file instead of the public MySQL server.
 """
-import mysql.connector
 import argparse 
+import collections
+import concurrent.futures
 import ftplib
 import gzip
-import io
-from io import BytesIO
+import os
+import pathlib
+import re
+import sqlite3
+import threading
+import zlib
+
+# Rfam FTP server and the directory holding the family fasta files
+FTP_HOST = "ftp.ebi.ac.uk"
+FTP_DIR = "pub/databases/Rfam/CURRENT/fasta_files/"
+
+# Directory of the table dumps on the Rfam FTP server
+DUMP_DIR = "pub/databases/Rfam/CURRENT/database_files/"
+
+# Number of bytes received from an FTP data connection at a time
+BLOCK_SIZE = 1 << 16
+
+# Tables and columns kept in the SQLite mirror. Each table is keyed on all of
+# its columns, so the rows of a table are stored once, in key order, and
+# double as the index the query needs.
+MIRROR_TABLES = {
+    "full_region": ("rfamseq_acc", "rfam_acc"),
+    "family": ("rfam_acc", "type"),
+    "rfamseq": ("ncbi_id", "rfamseq_acc"),
+    "taxonomy": ("ncbi_id", "species"),
+}
+
+# Columns of the mirror stored as integers; the rest are text
+INTEGER_COLUMNS = {"ncbi_id"}
+
+# Position of each kept column in the rows of the table dumps, used when the
+# CREATE TABLE statement of a table (its .sql file) is not available
+DUMP_POSITIONS = {
+    "full_region": {"rfam_acc": 0, "rfamseq_acc": 1},
+    "family": {"rfam_acc": 0, "type": 18},
+    "rfamseq": {"rfamseq_acc": 0, "ncbi_id": 3},
+    "taxonomy": {"ncbi_id": 0, "species": 1},
+}
+
+# Number of rows inserted into the mirror at a time
+INSERT_BATCH = 50000
+
+# Escape sequences of MySQL table dumps
+DUMP_ESCAPES = {b"0": b"\0", b"b": b"\b", b"n": b"\n", b"r": b"\r",
+                b"t": b"\t", b"Z": b"\x1a"}
+
+# A field of a MySQL table dump line and the tab (or end of line) after it
+DUMP_FIELD = re.compile(rb"((?:[^\t\\]|\\.)*)(\t|\Z)", re.DOTALL)
 
 
 def get_args():
@@ -27,8 +85,9 @@ def get_args():
                                                  "lengths, to be used on fastq "
                                                  "files that have already been "
                                                  "adapter-trimmed")
-    parser.add_argument("NCBI Species ID", type=str, help="NCBI taxonomy id of \
-                                                           species of interest")
+    parser.add_argument("NCBI Species ID", type=str, nargs="*", help="NCBI \
+                        taxonomy id of species of interest. Several ids make \
+                        one output file each")
     parser.add_argument("--output_dir", nargs="?", type=str, const="./",
                         default="./", help="Directory location for output file."
                                            " Set to current directory by "
@@ -36,20 +95,78 @@ def get_args():
     parser.add_argument("--filename", nargs="?", type=str, const="_rfam_no_\
         mirna.fasta", default="_rfam_no_mirna.fasta", help="Filename with \
                                 .fasta extension to write non-mirna reads to")
+    parser.add_argument("--connections", type=int, default=4, help="Number \
+                        of family files to download at the same time. Set to \
+                        4 by default")
+    parser.add_argument("--ftp_host", type=str, default=FTP_HOST, help="FTP \
+                        server to download family files from. Set to the Rfam \
+                        server by default")
+    parser.add_argument("--ftp_port", type=int, default=21, help="Port of the \
+                        FTP server")
+    parser.add_argument("--ftp_dir", type=str, default=FTP_DIR, help="\
+                        Directory of the family fasta files on the FTP server")
+    parser.add_argument("--cache_dir", type=str, help="Directory to keep \
+                        downloaded family files and query results in, so \
+                        later runs only download files that have changed")
+    parser.add_argument("--cache_size", type=int, default=2048, help="Most \
+                        megabytes of family files to keep in the cache. The \
+                        least recently used files are removed first. Set to \
+                        2048 by default; 0 for no limit")
+    parser.add_argument("--offline", action="store_true", help="Make the \
+                        output from the cache alone, without connecting to \
+                        the Rfam database or FTP server")
+    parser.add_argument("--mirror", type=str, help="SQLite mirror of the \
+                        Rfam tables to query instead of the public Rfam \
+                        database")
+    parser.add_argument("--build_mirror", type=str, metavar="DUMP_DIR", \
+                        help="Build the --mirror file from the Rfam table \
+                        dumps ({table}.txt or {table}.txt.gz, with their \
+                        {table}.sql files if available) in this directory, \
+                        or 'ftp' to stream them from the FTP server")
+    parser.add_argument("--ftp_dump_dir", type=str, default=DUMP_DIR, help="\
+                        Directory of the table dumps on the FTP server")
     args = parser.parse_args()
+    if not getattr(args, "NCBI Species ID") and args.build_mirror is None:
+        parser.error("at least one NCBI Species ID is required")
+    if args.build_mirror is not None and args.mirror is None:
+        parser.error("--build_mirror needs a --mirror file to build")
+    for ncbi in getattr(args, "NCBI Species ID"):
+        if not ncbi.isdigit():
+            parser.error("NCBI taxonomy ids must be numbers: " + ncbi)
+    if args.connections < 1:
+        parser.error("--connections must be at least 1")
+    if args.offline and args.cache_dir is None:
+        parser.error("--offline needs a --cache_dir")
 
     return args
 
 
-def create_connection():
+def create_connection(args):
     """This function creates a MySQL connection object to Rfam's public MYSQL
-    Database using connection details from their documentation website.
+    Database using connection details from their documentation website, or
+    opens the local SQLite mirror if one was given.
+    
+    Arguments:
+        args {Namespace} -- Elements of args can be accessed
+                     by their option name as attributes (e.g. args.filename 
+                     returns the stored input for the filename option)
      
     Returns:
         rfam_connect {MySQLConnection} -- A cursor made from this object can be 
         queried to retrieve information from the Rfam public database.
     """
-    
+    if args.mirror is not None:
+        if not os.path.exists(args.mirror):
+            print("Mirror file does not exist")
+            exit(1)
+        # Quote the path so that characters like # and ? in it are not read
+        # as parts of the URI
+        uri = pathlib.Path(os.path.abspath(args.mirror)).as_uri()
+        return sqlite3.connect(uri + "?mode=ro", uri=True)
+
+    # Only needed without a mirror, so --mirror, --build_mirror and --offline
+    # work without the MySQL driver installed
+    import mysql.connector
     rfam_connect = mysql.connector.connect(
         host="mysql-rfam-public.ebi.ac.uk",
         user="rfamro",
@@ -62,9 +179,9 @@ def create_connection():
 
 def get_accession(args, rfam_connect):
     """This function creates a cursor object, then queries the Rfam database for
-    non-mirna sequences for the organism whose ncbi taxonomic ID was passed as
-    a command line argument. A list of accession numbers containing these 
-    sequences is returned.
+    non-mirna sequences for the organisms whose ncbi taxonomic IDs were passed
+    as command line arguments, all in one query. The accession numbers of the
+    families containing these sequences are returned for each organism.
     
     Arguments:
         args {Namespace} -- Elements of args can be accessed
@@ -74,80 +191,691 @@ def get_accession(args, rfam_connect):
         queried to retrieve information from the Rfam public database.
     
     Returns:
-        results {list} -- A list of unique rfam accession numbers.
+        taxa {dict} -- Keys are NCBI taxonomy IDs and values are lists of
+                       unique (rfam accession number, species) tuples. IDs
+                       with no results are left out.
     """
-    ncbi = getattr(args, "NCBI Species ID")
+    ncbi_ids = getattr(args, "NCBI Species ID")
     rfam_cursor = rfam_connect.cursor()
-    query = "SELECT fr.rfam_acc, tx.species\
+    # MySQL and SQLite mark query parameters differently. Rows are read from
+    # the cursor as they come rather than all fetched first.
+    mark = "?" if isinstance(rfam_connect, sqlite3.Connection) else "%s"
+    query = "SELECT DISTINCT fr.rfam_acc, tx.ncbi_id, tx.species \
         FROM full_region fr, family f, rfamseq rf, taxonomy tx \
         WHERE rf.ncbi_id = tx.ncbi_id \
         AND f.rfam_acc = fr.rfam_acc \
         AND fr.rfamseq_acc = rf.rfamseq_acc \
-        AND f.type NOT LIKE '%miRNA%' \
-        AND rf.ncbi_id = " + ncbi + "\
-        AND tx.ncbi_id = " + ncbi 
-       
-    rfam_cursor.execute(query)
-    results = rfam_cursor.fetchall()
-    results = list(set(results))
-    if results == []:
-        print("No information found for the given NCBI ID")
+        AND f.type NOT LIKE " + mark + " \
+        AND tx.ncbi_id IN (" + ", ".join([mark] * len(ncbi_ids)) + ")"
+
+    rfam_cursor.execute(query, ["%miRNA%"] + [int(ncbi) for ncbi in ncbi_ids])
+    taxa = {}
+    for accession, ncbi, species in rfam_cursor:
+        taxa.setdefault(str(ncbi), []).append((accession, species))
+    rfam_cursor.close()
+
+    for ncbi in ncbi_ids:
+        if ncbi not in taxa:
+            print("No information found for NCBI ID " + ncbi)
+    if not taxa:
         exit(0)
-    species = " ".join(results[0][1].split()[0:2])
+    return taxa
+    
+
+def build_mirror(args):
+    """This function builds the SQLite mirror from the Rfam table dumps. Only
+    the columns in MIRROR_TABLES are kept. The mirror is built in a temporary
+    file next to it and moved into place once complete.
+    
+    Arguments:
+        args {Namespace} -- Elements of args can be accessed
+                     by their option name as attributes (e.g. args.filename 
+                     returns the stored input for the filename option)
+    """
+    partial = args.mirror + ".part"
+    if os.path.exists(partial):
+        os.remove(partial)
+    mirror = sqlite3.connect(partial)
+    mirror.execute("PRAGMA journal_mode = OFF")
+    mirror.execute("PRAGMA synchronous = OFF")
+    pool = FtpPool(args, args.ftp_dump_dir)
+    try:
+        for table, columns in MIRROR_TABLES.items():
+            definitions = [column + (" INTEGER" if column in INTEGER_COLUMNS
+                                     else " TEXT") for column in columns]
+            mirror.execute("CREATE TABLE {} ({}, PRIMARY KEY ({})) WITHOUT "
+                           "ROWID".format(table, ", ".join(definitions),
+                                          ", ".join(columns)))
+            insert = "INSERT OR IGNORE INTO {} VALUES ({})".format(
+                table, ", ".join(["?"] * len(columns)))
+            positions = dump_positions(args, pool, table)
+            rows = dump_rows(dump_lines(args, pool, table),
+                             [positions[column] for column in columns])
+            while True:
+                batch = [row for _, row in zip(range(INSERT_BATCH), rows)]
+                if not batch:
+                    break
+                mirror.executemany(insert, batch)
+            mirror.commit()
+            print("Loaded " + table)
+        mirror.execute("ANALYZE")
+        mirror.commit()
+    finally:
+        mirror.close()
+        pool.close()
+    os.replace(partial, args.mirror)
+
+
+def dump_lines(args, pool, table):
+    """This function gives the lines of the dump of a table, from the dump
+    directory or streamed from the FTP server.
+    
+    Returns:
+        A generator of lists of lines (as bytes, without line endings).
+    """
+    if args.build_mirror == "ftp":
+        return stream_lines(pool.connection(), table + ".txt.gz")
+    path = os.path.join(args.build_mirror, table + ".txt")
+    if os.path.exists(path + ".gz"):
+        return file_lines(path + ".gz")
+    if not os.path.exists(path):
+        print("No dump of the " + table + " table in " + args.build_mirror)
+        exit(1)
+    return plain_file_lines(path)
+
+
+def plain_file_lines(path):
+    with open(path, "rb") as infile:
+        for chunk in iter(lambda: infile.readlines(BLOCK_SIZE), []):
+            yield [line.rstrip(b"\n") for line in chunk]
+
+
+def dump_positions(args, pool, table):
+    """This function finds where the kept columns of a table are in the rows
+    of its dump, from the CREATE TABLE statement in its .sql file. Without the
+    file, the positions in DUMP_POSITIONS are used.
+    
+    Returns:
+        {dict} -- Keys are column names and values are their positions.
+    """
+    sql = None
+    if args.build_mirror == "ftp":
+        chunks = []
+        try:
+            pool.connection().retrbinary("RETR " + table + ".sql",
+                                         chunks.append)
+            sql = b"".join(chunks)
+        except ftplib.error_perm:
+            pass
+    elif os.path.exists(os.path.join(args.build_mirror, table + ".sql")):
+        with open(os.path.join(args.build_mirror, table + ".sql"),
+                  "rb") as sql_file:
+            sql = sql_file.read()
+    if sql is None:
+        return DUMP_POSITIONS[table]
+
+    body = sql[sql.index(b"CREATE TABLE"):]
+    names = re.findall(rb"^\s*`(\w+)`", body[body.index(b"(") + 1:],
+                       re.MULTILINE)
+    names = [name.decode("utf-8") for name in names]
+    return {column: names.index(column) for column in MIRROR_TABLES[table]}
+
+
+def dump_rows(lines, positions):
+    """This function reads the rows of a MySQL table dump: one row per line,
+    fields separated by tabs, with tabs, newlines and backslashes in a field
+    escaped by a backslash and NULL written as \\N.
     
-    return results, species
+    Arguments:
+        lines -- An iterable of lists of lines, as given by dump_lines.
+        positions {list} -- Positions of the fields to keep.
     
+    Returns:
+        A generator of tuples of the kept fields (as str, or None for NULL).
+    """
+    pending = None
+    for chunk in lines:
+        for line in chunk:
+            # A backslash at the very end of a line escapes the newline, which
+            # is part of the field
+            if pending is not None:
+                line = pending + b"\n" + line
+                pending = None
+            if line.endswith(b"\\") and \
+                    (len(line) - len(line.rstrip(b"\\"))) % 2:
+                pending = line[:-1]
+                continue
+            if not line:
+                continue
+            if b"\\" in line:
+                fields = split_escaped(line)
+            else:
+                fields = line.split(b"\t")
+            yield tuple(unescape(fields[i]) for i in positions)
+
+
+def split_escaped(line):
+    # Split a dump line on the tabs that are not escaped by a backslash
+    fields = []
+    for match in DUMP_FIELD.finditer(line):
+        fields.append(match.group(1))
+        if not match.group(2):
+            break
+    return fields
+
+
+def unescape(field):
+    if field == b"\\N":
+        return None
+    if b"\\" in field:
+        field = re.sub(rb"\\(.)", lambda match: DUMP_ESCAPES.get(
+            match.group(1), match.group(1)), field, flags=re.DOTALL)
+    return field.decode("utf-8")
+
+
+def species_name(results):
+    """This function gives the name of the species of a set of query results.
+    
+    Arguments:
+        results {list} -- A list of (rfam accession number, species) tuples.
+    
+    Returns:
+        {str} -- The first two words (genus and species) of the species.
+    """
+    return " ".join(results[0][1].split()[0:2])
+
 
-def make_genome(results, species, args):
-    """This function iterates through a list of rfam accession numbers, pulls
-    their respetive fasta files from the appropriate Rfam daatabase directory,
-    and write the lines from these files into a single fasta file.
+def output_filename(args, ncbi):
+    """This function gives the name of the output file of a taxonomy ID.
     
     Arguments:
-        results {list} -- A list of unique rfam accession numbers.
-        species {str} -- The name of the species corresponding to the given 
-                         NCBI taxonomy ID
         args {Namespace} -- Elements of args can be accessed
                      by their option name as attributes (e.g. args.filename 
                      returns the stored input for the filename option)
+        ncbi {str} -- NCBI taxonomy ID.
+    
+    Returns:
+        {str} -- {output_dir} + {ncbi} + {filename} with the default filename,
+                 or {output_dir} + {filename} for a single ID given a
+                 filename. With several IDs, each filename starts with the
+                 ID.
     """
     if args.filename == "_rfam_no_mirna.fasta":
-        o_filename = args.output_dir + getattr(args, "NCBI Species ID") \
-                    + args.filename
-    else: 
-        o_filename = args.output_dir + args.filename
+        return args.output_dir + ncbi + args.filename
+    if len(getattr(args, "NCBI Species ID")) == 1:
+        return args.output_dir + args.filename
+    return args.output_dir + ncbi + "_" + args.filename
+
+
+def species_routes(taxa):
+    """This function works out, for each family, which taxonomy IDs each
+    species' reads in its fasta file are to be written for. A read is only
+    written for an ID whose query results list the family.
+    
+    Arguments:
+        taxa {dict} -- Query results of each taxonomy ID, as given by
+                       get_accession.
+    
+    Returns:
+        routes {dict} -- Keys are rfam accession numbers. Values are
+                         dictionaries where keys are species names (as bytes)
+                         and values are lists of taxonomy IDs.
+    """
+    routes = {}
+    for ncbi, results in taxa.items():
+        species = species_name(results).encode("utf-8")
+        for accession in set(str(result[0]) for result in results):
+            ids = routes.setdefault(accession, {}).setdefault(species, [])
+            if ncbi not in ids:
+                ids.append(ncbi)
+    return routes
+
+
+def make_genome(taxa, args, cache=None):
+    """This function pulls the fasta file of each rfam accession number from
+    the appropriate Rfam database directory, and writes the reads of each
+    species from these files into the fasta file of its taxonomy ID. Each
+    family file is read once however many species it holds. Files are
+    downloaded on a pool of args.connections FTP connections, and are written
+    in order of accession number whichever finishes first.
     
-    with ftplib.FTP("ftp.ebi.ac.uk") as ftp:
-        with open(o_filename, 'w') as outfile:
+    Arguments:
+        taxa {dict} -- Query results of each taxonomy ID, as given by
+                       get_accession.
+        args {Namespace} -- Elements of args can be accessed
+                     by their option name as attributes (e.g. args.filename 
+                     returns the stored input for the filename option)
+        cache {RfamCache} -- Cache of family files to use, or None.
+    """
+    routes = species_routes(taxa)
+    accessions = sorted(routes)
+    if args.offline:
+        missing = [accession for accession in accessions
+                   if not cache.has(accession + ".fa.gz")]
+        if missing:
+            print("Not in the cache: " + ", ".join(missing))
+            exit(1)
+
+    outfiles = {}
+    pool = FtpPool(args)
+    try:
+        for ncbi in taxa:
+            outfiles[ncbi] = open(output_filename(args, ncbi), 'wb')
+        with concurrent.futures.ThreadPoolExecutor(args.connections) as \
+                executor:
+            # Keep a few files per connection in flight, and write each one
+            # as soon as every file before it has been written
+            pending = collections.deque()
+            for accession in accessions:
+                pending.append(executor.submit(fetch_family, pool,
+                                               accession + ".fa.gz",
+                                               routes[accession], cache))
+                if len(pending) > 2 * args.connections:
+                    write_family(outfiles, pending.popleft().result())
+            while pending:
+                write_family(outfiles, pending.popleft().result())
+    finally:
+        for outfile in outfiles.values():
+            outfile.close()
+        pool.close()
+        if cache is not None:
+            cache.evict()
+
+
+def write_family(outfiles, records):
+    for ncbi, data in records.items():
+        outfiles[ncbi].write(data)
+
+
+class FtpPool:
+    """One FTP connection per worker thread, logged in and in the family file
+    directory (or another given directory), made the first time the thread
+    needs it and kept for every file the thread downloads after that.
+    """
+
+    def __init__(self, args, directory=None):
+        self.args = args
+        self.directory = args.ftp_dir if directory is None else directory
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def connection(self):
+        """This function gives the FTP connection of the calling thread.
+        
+        Returns:
+            ftp {FTP} -- A logged in connection to the Rfam FTP server.
+        """
+        ftp = getattr(self._local, "ftp", None)
+        if ftp is None:
+            ftp = ftplib.FTP()
+            ftp.connect(self.args.ftp_host, self.args.ftp_port)
             ftp.login()
-            ftp.cwd("pub/databases/Rfam/CURRENT/fasta_files/")
-            for result in results:
-                accession = str(result[0]) + ".fa.gz"
-                flo = BytesIO()
-                ftp.retrbinary("RETR " + accession, flo.write)
-                flo.seek(0)
-                wrapper = io.TextIOWrapper(gzip.GzipFile(fileobj=flo))
-                print_read = False
-                for line in wrapper:
-                    if line.startswith('>'):
-                        if species in line.rstrip():
-                            outfile.write(line.rstrip() + "\n")
-                            print_read = True
-                        else: 
-                            print_read = False
-                    else:
-                        if print_read == True:
-                            outfile.write(line.rstrip() + "\n")
-
-                flo.close()
+            ftp.cwd(self.directory)
+            self._local.ftp = ftp
+            with self._lock:
+                self._connections.append(ftp)
+        return ftp
+
+    def close(self):
+        for ftp in self._connections:
+            try:
+                ftp.quit()
+            except ftplib.all_errors:
+                ftp.close()
+
+
+def stream_lines(ftp, filename, save=None):
+    """This function downloads a gzipped file, decompressing it as the data
+    arrives, so the whole file is never held in memory. EOFError is raised if
+    the download ends before the end of the file.
+    
+    Arguments:
+        ftp {FTP} -- A logged in FTP connection.
+        filename {str} -- Name of the gzipped file on the server.
+        save {file} -- A binary file object to also write the file to as it
+                       is downloaded, still compressed, or None.
+    
+    Returns:
+        A generator of lists of lines (as bytes, without line endings).
+    """
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    leftover = b""
+    received = 0
+    ftp.voidcmd("TYPE I")
+    try:
+        size = ftp.size(filename)
+    except ftplib.error_perm:
+        size = None
+    with ftp.transfercmd("RETR " + filename) as conn:
+        while True:
+            data = conn.recv(BLOCK_SIZE)
+            if not data:
+                break
+            received += len(data)
+            if save is not None:
+                save.write(data)
+            chunk = decompressor.decompress(data)
+            # A gzip file may hold several members one after another
+            while decompressor.eof and decompressor.unused_data:
+                data = decompressor.unused_data
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                chunk += decompressor.decompress(data)
+            lines = (leftover + chunk).split(b"\n")
+            leftover = lines.pop()
+            yield lines
+    ftp.voidresp()
+    if not decompressor.eof or decompressor.unused_data or \
+            (size is not None and received != size):
+        raise EOFError("Download of " + filename + " ended before the end "
+                       "of the file")
+    if leftover:
+        yield [leftover]
+
+
+def file_lines(path):
+    """This function reads a gzipped file from disk in large blocks.
+    
+    Arguments:
+        path {str} -- Name of the gzipped file.
+    
+    Returns:
+        A generator of lists of lines (as bytes, without line endings).
+    """
+    leftover = b""
+    with gzip.open(path, "rb") as infile:
+        for chunk in iter(lambda: infile.read(BLOCK_SIZE), b""):
+            lines = (leftover + chunk).split(b"\n")
+            leftover = lines.pop()
+            yield lines
+    if leftover:
+        yield [leftover]
+
+
+def family_lines(pool, filename, cache):
+    """This function gives the lines of a family fasta file, from the cache if
+    the cached copy is still the same size and age as the file on the server,
+    and otherwise from the server, saving it to the cache as it downloads.
+    
+    Arguments:
+        pool {FtpPool} -- Connections to download the file with.
+        filename {str} -- Name of the family fasta file on the server.
+        cache {RfamCache} -- Cache of family files to use, or None.
+    
+    Returns:
+        A generator of lists of lines (as bytes, without line endings).
+    """
+    if cache is None:
+        yield from stream_lines(pool.connection(), filename)
+        return
+    if pool.args.offline:
+        cache.touch(filename)
+        yield from file_lines(cache.path(filename))
+        return
+
+    ftp = pool.connection()
+    stamp = remote_stamp(ftp, filename)
+    if cache.is_current(filename, stamp):
+        cache.touch(filename)
+        yield from file_lines(cache.path(filename))
+        return
+
+    with cache.store(filename, stamp) as save:
+        yield from stream_lines(ftp, filename, save)
+
+
+def stamp_size(stamp):
+    """This function gives the size of a file from its stamp.
+    
+    Arguments:
+        stamp {str} -- Size and time of a file, as given by remote_stamp.
+    
+    Returns:
+        {int} -- The size of the file in bytes, or None if the server did not
+                 give one.
+    """
+    size = stamp.split("\t", 1)[0]
+    return int(size) if size.isdigit() else None
+
+
+def remote_stamp(ftp, filename):
+    """This function asks the FTP server for the size and modification time of
+    a file, which together tell whether a cached copy is out of date.
+    
+    Arguments:
+        ftp {FTP} -- A logged in FTP connection.
+        filename {str} -- Name of the file on the server.
+    
+    Returns:
+        {str} -- The size and MDTM time of the file, tab-separated. The time
+                 is left empty if the server does not support MDTM.
+    """
+    ftp.voidcmd("TYPE I")
+    size = ftp.size(filename)
+    try:
+        mdtm = ftp.sendcmd("MDTM " + filename).split()[1]
+    except ftplib.error_perm:
+        mdtm = ""
+    return "{}\t{}".format(size, mdtm)
+
+
+class RfamCache:
+    """A directory of downloaded family fasta files. Next to each file is a
+    .stamp file with the size and modification time the file had on the
+    server. The modification time of each cached file is set whenever it is
+    used, so that the least recently used files can be removed first once the
+    cache is over its size limit. Query results of each taxonomy ID are kept
+    too, for --offline.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size * 1024 * 1024
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def has(self, filename):
+        return os.path.exists(self.path(filename))
+
+    def is_current(self, filename, stamp):
+        """This function tests whether a cached file matches the file on the
+        server.
+        
+        Arguments:
+            filename {str} -- Name of the family fasta file.
+            stamp {str} -- Size and time of the file on the server, as given
+                           by remote_stamp.
+        
+        Returns:
+            {bool} -- True if the file is cached with the same stamp, and is
+                      as big as the stamp says.
+        """
+        try:
+            with open(self.path(filename) + ".stamp") as stamp_file:
+                if stamp_file.read() != stamp:
+                    return False
+            size = stamp_size(stamp)
+            return size is None or \
+                os.path.getsize(self.path(filename)) == size
+        except FileNotFoundError:
+            return False
+
+    def touch(self, filename):
+        os.utime(self.path(filename))
+
+    def store(self, filename, stamp):
+        """This function opens a cache file for a family file being downloaded.
+        The file only replaces the cached copy once it has been closed after a
+        whole download.
+        
+        Arguments:
+            filename {str} -- Name of the family fasta file.
+            stamp {str} -- Size and time of the file on the server, as given
+                           by remote_stamp.
+        
+        Returns:
+            {CacheWriter} -- A binary file object to write the file to.
+        """
+        return CacheWriter(self, filename, stamp)
+
+    def evict(self):
+        """This function removes the least recently used family files until
+        the cache is no bigger than its size limit.
+        """
+        if not self.max_size:
+            return
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".fa.gz"):
+                info = os.stat(self.path(name))
+                files.append((info.st_mtime, info.st_size, name))
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.max_size:
+                break
+            for path in (self.path(name), self.path(name) + ".stamp"):
+                if os.path.exists(path):
+                    os.remove(path)
+            total -= size
+
+    def results_path(self, ncbi):
+        return self.path("taxon_" + ncbi + ".tsv")
+
+    def save_results(self, ncbi, results):
+        """This function keeps the query results of a taxonomy ID.
+        
+        Arguments:
+            ncbi {str} -- NCBI taxonomy ID.
+            results {list} -- A list of (rfam accession number, species)
+                              tuples.
+        """
+        with open(self.results_path(ncbi), "w") as results_file:
+            for accession, species in results:
+                results_file.write(accession + "\t" + species + "\n")
+
+    def load_results(self, ncbi):
+        """This function reads the query results kept for a taxonomy ID.
+        
+        Arguments:
+            ncbi {str} -- NCBI taxonomy ID.
+        
+        Returns:
+            results {list} -- A list of (rfam accession number, species)
+                              tuples, or None if none were kept.
+        """
+        try:
+            with open(self.results_path(ncbi)) as results_file:
+                return [tuple(line.rstrip("\n").split("\t", 1))
+                        for line in results_file]
+        except FileNotFoundError:
+            return None
+
+
+class CacheWriter:
+    """A file a family file is downloaded into, next to its place in the cache.
+    On a clean close it is renamed into place and its stamp written; if the
+    download fails part way, or is not the size given in the stamp, it is
+    deleted and the cache is left as it was.
+    """
+
+    def __init__(self, cache, filename, stamp):
+        self.cache = cache
+        self.filename = filename
+        self.stamp = stamp
+        self._path = cache.path(filename) + ".part"
+        self._file = open(self._path, "wb")
+        self._written = 0
+
+    def write(self, data):
+        self._written += len(data)
+        return self._file.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self._file.close()
+        if exc_type is not None:
+            os.remove(self._path)
+            return
+        size = stamp_size(self.stamp)
+        if size is not None and self._written != size:
+            os.remove(self._path)
+            raise EOFError("Download of " + self.filename + " ended after " +
+                           str(self._written) + " of " + str(size) + " bytes")
+        os.replace(self._path, self.cache.path(self.filename))
+        with open(self.cache.path(self.filename) + ".stamp", "w") as stamp:
+            stamp.write(self.stamp)
+
+
+def fetch_family(pool, filename, species, cache=None):
+    """This function gets the fasta file of one Rfam family and sorts the
+    reads of the given species by taxonomy ID. The species of a read is the
+    start of the description in its header (after the sequence name), which
+    is looked up in species rather than searched for in the whole line.
+    
+    Arguments:
+        pool {FtpPool} -- Connections to download the file with.
+        filename {str} -- Name of the family fasta file on the server.
+        species {dict} -- Keys are species names (as bytes) to keep reads of
+                          and values are lists of the taxonomy IDs to keep
+                          them for.
+        cache {RfamCache} -- Cache of family files to use, or None.
+    
+    Returns:
+        {dict} -- Keys are taxonomy IDs and values are the fasta records (as
+                  bytes) of their species.
+    """
+    # Number of words in each species name, so the header is only cut up as
+    # many ways as needed
+    sizes = sorted(set(len(name.split()) for name in species))
+    out = {ncbi: [] for ids in species.values() for ncbi in ids}
+    targets = []
+    for lines in family_lines(pool, filename, cache):
+        for line in lines:
+            line = line.rstrip()
+            if line.startswith(b'>'):
+                words = line.split(None, sizes[-1] + 1)[1:]
+                targets = []
+                for size in sizes:
+                    targets = species.get(b" ".join(words[:size]), [])
+                    if targets:
+                        break
+            for ncbi in targets:
+                out[ncbi].append(line + b"\n")
+    return {ncbi: b"".join(records) for ncbi, records in out.items()}
 
 
 def main():
     args = get_args()
-    rfam_connect = create_connection()
-    results, species = get_accession(args, rfam_connect)
-    print("Species identified as " + species)
-    make_genome(results, species, args)
+    if args.build_mirror is not None:
+        build_mirror(args)
+        if not getattr(args, "NCBI Species ID"):
+            return
+
+    cache = None
+    if args.cache_dir is not None:
+        cache = RfamCache(args.cache_dir, args.cache_size)
+
+    if args.offline:
+        taxa = {}
+        for ncbi in getattr(args, "NCBI Species ID"):
+            taxa[ncbi] = cache.load_results(ncbi)
+            if taxa[ncbi] is None:
+                print("No query results in the cache for NCBI ID " + ncbi)
+                exit(1)
+    else:
+        rfam_connect = create_connection(args)
+        taxa = get_accession(args, rfam_connect)
+        if cache is not None:
+            for ncbi, results in taxa.items():
+                cache.save_results(ncbi, results)
+    for ncbi, results in taxa.items():
+        print("Species identified as " + species_name(results) +
+              " for NCBI ID " + ncbi)
+    make_genome(taxa, args, cache)
 
 
 if __name__ == "__main__":
@@ -6,12 +6,21 @@ Last updated: 7/26/19
 This program filters reads by length from a fastq file (.fastq, .fq, .fastq.gz,
 .fq.gz) into a fastq file. Options include a minimum length and maximum length
 to filter by, an output directory, and the option to gzip the output file.
+Reads can also be split by length into several files in one pass, with
+--bins or --per_length, and a histogram of read lengths can be written
+alongside.
 """
 __author__ = "boseHere"
 import argparse
-import gzip
+import collections
 import os
 
+import bgzf
+import fastq_io
+
+# Number of reads to hold in memory before writing them to the output file
+WRITE_BATCH = 10000
+
 
 def get_args():
     """
@@ -27,8 +36,13 @@ def get_args():
                                                  "files that have already been "
                                                  "adapter-trimmed")
     parser.add_argument("input", type=str, help="Input file name")
-    parser.add_argument("--gzip", help="Gzip the output file",
+    parser.add_argument("--gzip", help="Gzip the output file. The output is "
+                                       "written in BGZF format, which can be "
+                                       "read by any gzip tool",
                         action="store_true")
+    parser.add_argument("--compression_level", type=int, default=6,
+                        help="Gzip compression level of the output file, from "
+                             "0 (fastest) to 9 (smallest). Set to 6 by default")
     parser.add_argument("--min_length", nargs='?', type=int, const=0, default=0,
                         help="Shortest read length to include in output. Set "
                              "to 0 by default")
@@ -39,10 +53,49 @@ def get_args():
                         default="./", help="Directory location for output file."
                                            " Set to current directory by "
                                            "default")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Number of threads to decompress gzipped input "
+                             "and compress gzipped output with. Set to 1 by "
+                             "default")
+    parser.add_argument("--bins", nargs="+", type=parse_bin,
+                        help="Split reads into one output file per bin of "
+                             "lengths, each given as a length (e.g. 22) or a "
+                             "range (e.g. 18-20). A read is written to every "
+                             "bin that holds its length. --min_length and "
+                             "--max_length are ignored")
+    parser.add_argument("--per_length", action="store_true",
+                        help="Split reads into one output file per read length "
+                             "between --min_length and --max_length")
+    parser.add_argument("--histogram", action="store_true",
+                        help="Also write the number of reads of each length "
+                             "in the input file to {output_dir}lengths_ + "
+                             "{input file name} + .txt")
     args = parser.parse_args()
+    if args.bins and args.per_length:
+        parser.error("Only one of --bins and --per_length can be used")
     return args
 
 
+def parse_bin(text):
+    """
+    This function reads a bin of read lengths given on the command line.
+    :param: text -- A length (e.g. "22") or a range of lengths (e.g. "18-20").
+    :return: A tuple of the shortest and longest length of the bin.
+    """
+    try:
+        if "-" in text:
+            low, high = [int(part) for part in text.split("-")]
+        else:
+            low = high = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Bins must be a length or a range of "
+                                         "lengths, e.g. 22 or 18-20")
+    if low < 0 or high < low:
+        raise argparse.ArgumentTypeError("Bin " + text + " is not a valid "
+                                         "range of lengths")
+    return low, high
+
+
 def create_params(args):
     """
     This function uses attributes of the args object to create parameters for
@@ -60,14 +113,6 @@ def create_params(args):
                          range}_ + {input file name}
     """
 
-    # Initialize the name of the output file to the name of the input file
-    path = os.path.abspath(args.input)
-    base = path.rfind("/")
-    if base == -1:
-        outfile = args.input
-    else:
-        outfile = path[base + 1:]
-
     # Test for valid user input for minimum and maximum read lengths.
     if args.min_length < 0:
         print("Minimum read length must be greater than or equal to 0")
@@ -83,144 +128,280 @@ def create_params(args):
                   "maximum read length")
             exit(1)
 
+    # A maximum length of 0 means there is no maximum
+    outfile = output_filename(args, args.min_length, args.max_length or None)
+    gzipped = (args.input[-3:] == ".gz")
+
+    if not 0 <= args.compression_level <= 9:
+        print("Compression level must be between 0 and 9")
+        exit(1)
+
+    return gzipped, outfile
+
+
+def output_filename(args, min_length, max_length, prefix="trimmed_"):
+    """
+    This function gives the name of an output file for a range of lengths.
+    :params: args -- An argparse object. Elements of the object can be accessed
+                     by their option name as attributes (e.g. args.gzip returns
+                     the user input for the gzip option)
+
+             min_length -- Shortest read length written to the file.
+
+             max_length -- Longest read length written to the file, or None
+                           if there is no maximum.
+
+             prefix -- Start of the file name, before the length range.
+    :return: outfile -- Consists of {output directory} + {prefix} + {length
+                        range}_ + {input file name}, with .gz at the end if
+                        the --gzip option has been used. With a min_length of
+                        None, the length range is left out.
+    """
+
+    # Initialize the name of the output file to the name of the input file
+    path = os.path.abspath(args.input)
+    base = path.rfind("/")
+    if base == -1:
+        outfile = args.input
+    else:
+        outfile = path[base + 1:]
+
+    if min_length is None:
+        outfile = prefix + outfile
+    elif max_length is not None:
         # Add read length range to name of output file
-        outfile = "trimmed_" + str(args.min_length) + "_" + \
-                  str(args.max_length) + "_" + outfile
+        outfile = prefix + str(min_length) + "_" + str(max_length) + "_" + \
+                  outfile
     else:
         # Add read length range to name of output file (if no max length is
         # given)
-        outfile = "trimmed_" + str(args.min_length) + "_maxLen_" + outfile
+        outfile = prefix + str(min_length) + "_maxLen_" + outfile
 
     # Add output directory path to output file name
     outfile = str(args.output_dir) + outfile
 
     # If the input file is in gzipped format, remove the gzip file extension
-    # from the output file name and set the value of the variable gzipped to
-    # true.
+    # from the output file name
     if args.input[-3:] == ".gz":
-        gzipped = True
         outfile = outfile[:-3]
-    else:
-        gzipped = False
 
     # If the --gzip option has been used, add the gzip file extension to the
     # output file name
     if args.gzip:
         outfile = outfile + ".gz"
 
-    return gzipped, outfile
+    return outfile
 
 
-def open_files(args, outfile):
+def open_output(args, outfile):
     """
-    This function opens the input file for reading and opens the output file
-    for writing.
+    This function opens an output file for binary writing.
     :params: args -- An argparse object. Elements of the object can be accessed
                      by their option name as attributes (e.g. args.gzip returns
                      the user input for the gzip option)
-                     
-             outfile -- The name of the file to be written to.
-    :returns: infile -- A file object to be read from.
 
-              writefile -- A file object to be written to.
+             outfile -- The name of the file to be written to.
+    :return: writefile -- A file object to be written to. A bgzf.BgzfWriter if
+                          the --gzip option has been used.
     """
     try:
         if args.gzip:
-            writefile = gzip.open(outfile, "w+")
-        else:
-            writefile = open(outfile, "w+")
+            return bgzf.BgzfWriter(outfile, args.compression_level,
+                                   args.threads)
+        return open(outfile, "wb")
     except FileNotFoundError:
         print("Output directory does not exist")
         exit(1)
 
+
+def open_files(args, gzipped, outfile):
+    """
+    This function opens the input file for reading and opens the output file
+    for writing. Both files are opened in binary mode.
+    :params: args -- An argparse object. Elements of the object can be accessed
+                     by their option name as attributes (e.g. args.gzip returns
+                     the user input for the gzip option)
+
+             gzipped -- A boolean. True if the input file is in gzipped format.
+
+             outfile -- The name of the file to be written to.
+    :returns: infile -- A file object to be read from.
+
+              writefile -- A file object to be written to.
+    """
+    writefile = open_output(args, outfile)
+    infile = open_input(args, gzipped)
+    return infile, writefile
+
+
+def open_input(args, gzipped):
+    """
+    This function opens the input file for binary reading.
+    :params: args -- An argparse object. Elements of the object can be accessed
+                     by their option name as attributes (e.g. args.gzip returns
+                     the user input for the gzip option)
+
+             gzipped -- A boolean. True if the input file is in gzipped format.
+    :return: infile -- A file object to be read from.
+    """
     try:
         if gzipped:
-            infile = gzip.open(args.input, "r")
-        else:
-            infile = open(args.input, "r")
+            return fastq_io.open_gzip(args.input, args.threads)
+        return open(args.input, "rb")
     except FileNotFoundError:
         print("Input file does not exist")
         exit(1)
 
-    return infile, writefile
-
 
-def filter(args, gzipped, infile, writefile):
+def filter(args, infile, writefile):
     """
-    This function loops through the input file, determines which reads fit
-    within the given length range, and write these reads and their information
-    to the output file.
+    This function loops through the reads of the input file, determines which
+    reads fit within the given length range, and write these reads and their
+    information to the output file.
     :params: args -- An argparse object. Elements of the object can be accessed
                      by their option name as attributes (e.g. args.gzip returns
                      the user input for the gzip option)
 
-             gzipped -- A boolean. True if the input file is in gzipped format.
-                         Not to be confused with args.gzip, which is True if
-                         the output file is to be gzipped.
-
-             infile -- A file object to be read from.
+             infile -- A binary file object to be read from.
 
-             writefile -- A file object to be written to.
+             writefile -- A binary file object to be written to.
     :return: none
     """
+    # Reads that fit within the user given range of lengths are collected and
+    # written to the output file in large chunks
+    buffer = []
+    for record in filter_lengths(fastq_io.read_records(infile),
+                                 args.min_length, args.max_length):
+        buffer.append(fastq_io.format_record(record))
+        if len(buffer) >= WRITE_BATCH:
+            writefile.write(b"".join(buffer))
+            buffer = []
 
-    i = 0
-    fits = False
+    writefile.write(b"".join(buffer))
 
-    for line in infile:
-        if gzipped:
-            line = line.decode("utf-8")
-        line = line.strip()
-
-        if i == 0:
-            line1 = line + "\n"
-
-        # Second line of every read entry (total 4 lines) in fastq format is
-        # actual read sequence. Test if the length of this read is within the
-        # user given range of lengths.
-        elif i == 1:
-
-            if args.max_length:
-                if args.min_length <= len(line) <= args.max_length:
-                    fits = True
-                else:
-                    fits = False
+
+def filter_lengths(records, min_length, max_length):
+    """
+    This function passes on only the reads within a range of lengths.
+    :params: records -- An iterable of reads as 4-tuples of bytes objects.
+
+             min_length -- Shortest read length to pass on.
+
+             max_length -- Longest read length to pass on, or None (or 0) for
+                           no maximum.
+    :return: A generator of reads as 4-tuples of bytes objects.
+    """
+    max_length = max_length or float("inf")
+    for record in records:
+        if min_length <= len(record[1]) <= max_length:
+            yield record
+
+
+def split(args, infile, bins):
+    """
+    This function loops through the reads of the input file once and writes
+    each read to the output file of every bin that holds its length, counting
+    the reads of each length as it goes. Output files of --bins are opened up
+    front; with --per_length, the file of a length is opened when the first
+    read of that length is found.
+    :params: args -- An argparse object. Elements of the object can be accessed
+                     by their option name as attributes (e.g. args.gzip returns
+                     the user input for the gzip option)
+
+             infile -- A binary file object to be read from.
+
+             bins -- A list of (shortest length, longest length) tuples, or
+                     None to make one bin per length between args.min_length
+                     and args.max_length. A longest length of None means
+                     there is no maximum.
+    :return: histogram -- A Counter where keys are read lengths and values are
+                          the number of reads of that length.
+    """
+    min_length = args.min_length
+    max_length = args.max_length or float("inf")
+
+    # Each bin has an output file and a list of reads waiting to be written
+    # to it
+    outputs = {}
+    if bins is not None:
+        for low, high in bins:
+            if (low, high) not in outputs:
+                outputs[(low, high)] = (open_output(args, output_filename(
+                    args, low, high)), [])
+
+    # The outputs each read length is written to, worked out the first time
+    # the length is seen
+    routes = {}
+    histogram = collections.Counter()
+    for record in fastq_io.read_records(infile):
+        length = len(record[1])
+        histogram[length] += 1
+        targets = routes.get(length)
+        if targets is None:
+            if bins is not None:
+                targets = [output for (low, high), output in outputs.items()
+                           if low <= length and
+                           (high is None or length <= high)]
+            elif min_length <= length <= max_length:
+                outputs[(length, length)] = (open_output(args, output_filename(
+                    args, length, length)), [])
+                targets = [outputs[(length, length)]]
             else:
-                if args.min_length <= len(line):
-                    fits = True
-                else:
-                    fits = False
-            line2 = line + "\n"
-        elif i == 2:
-            line3 = line + "\n"
-
-        elif i == 3 and fits:  # If the length of the read sequence from line 2
-                                # was within  the user given range of lengths,
-                                # write all the information for that read to the
-                                # output file.
-            line4 = line + "\n"
-
-            if args.gzip:
-                line1 = line1.encode("utf-8")
-                line2 = line2.encode("utf-8")
-                line3 = line3.encode("utf-8")
-                line4 = line4.encode("utf-8")
-
-            writefile.write(line1)
-            writefile.write(line2)
-            writefile.write(line3)
-            writefile.write(line4)
-
-        i += 1
-        if i == 4:
-            i = 0
+                targets = []
+            routes[length] = targets
+
+        if targets:
+            text = fastq_io.format_record(record)
+            for writefile, buffer in targets:
+                buffer.append(text)
+                if len(buffer) >= WRITE_BATCH:
+                    writefile.write(b"".join(buffer))
+                    buffer.clear()
+
+    for writefile, buffer in outputs.values():
+        writefile.write(b"".join(buffer))
+        writefile.close()
+    return histogram
+
+
+def write_histogram(args, histogram):
+    """
+    This function writes the number of reads of each length to a
+    tab-separated file, shortest length first.
+    :params: args -- An argparse object. Elements of the object can be accessed
+                     by their option name as attributes (e.g. args.gzip returns
+                     the user input for the gzip option)
+
+             histogram -- A Counter of read lengths as made by split.
+    :return: none
+    """
+    filename = output_filename(args, None, None, "lengths_")
+    if args.gzip:
+        filename = filename[:-3]
+    with open(filename + ".txt", "w") as histfile:
+        histfile.write("Length\tReads\n")
+        for length in sorted(histogram):
+            histfile.write(str(length) + "\t" + str(histogram[length]) + "\n")
 
 
 if __name__ == "__main__":
     args = get_args()
     gzipped, outfile = create_params(args)
-    infile, writefile = open_files(args, outfile)
-    filter(args, gzipped, infile, writefile)
+    if args.bins or args.per_length or args.histogram:
+        if args.bins:
+            bins = args.bins
+        elif args.per_length:
+            bins = None
+        else:
+            bins = [(args.min_length, args.max_length or None)]
+        infile = open_input(args, gzipped)
+        histogram = split(args, infile, bins)
+        infile.close()
+        if args.histogram:
+            write_histogram(args, histogram)
+    else:
+        infile, writefile = open_files(args, gzipped, outfile)
+        filter(args, infile, writefile)
 
-    writefile.close()
-    infile.close()
+        writefile.close()
+        infile.close()
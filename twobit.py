@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+Reading and writing genomes in the UCSC .2bit format. Each base is stored in
+two bits (T, C, A, G), with runs of N and of lowercase (soft-masked) bases
+kept as separate lists of blocks, so a genome takes about a quarter of the
+space of its fasta file. The file is memory-mapped and only the bytes of the
+requested bases are decoded.
+"""
+__author__ = "boseHere"
+import array
+import bisect
+import mmap
+import os
+import re
+import shutil
+import struct
+import sys
+import tempfile
+
+import fastq_io
+
+SIGNATURE = 0x1A412743
+
+# Two-bit code of each base. Anything that is not A, C, G or T is stored as T
+# and covered by an N block.
+CODES = bytes.maketrans(b"TCAGtcag", b"\x00\x01\x02\x03\x00\x01\x02\x03")
+CODES = bytes(code if code < 4 else 0 for code in CODES)
+
+# The four bases held in each possible packed byte
+DECODE = ["".join("TCAG"[byte >> shift & 3] for shift in (6, 4, 2, 0)).encode()
+          for byte in range(256)]
+
+N_BLOCKS = re.compile(rb"[^ACGTacgt]+")
+MASK_BLOCKS = re.compile(rb"[a-z]+")
+
+
+class TwoBitError(Exception):
+    """Raised when a .2bit file cannot be read."""
+
+
+def pack(seq):
+    """
+    This function packs a sequence into two bits per base, four bases per
+    byte with the first base in the highest bits. The work is done on the
+    whole sequence at once as a single integer, so no Python loop runs per
+    base.
+    :param: seq -- A bytes object of bases.
+    :return: A bytes object of (len(seq) + 3) // 4 bytes.
+    """
+    codes = seq.translate(CODES)
+    codes += b"\x00" * (-len(codes) % 4)
+    if not codes:
+        return b""
+    size = len(codes)
+    value = int.from_bytes(codes, "big")
+
+    # Each code sits in the low two bits of its own byte. Merge neighbouring
+    # bytes into the low four bits of each 16-bit word, then neighbouring
+    # words into the low eight bits of each 32-bit word.
+    value = (value | value >> 6) & int.from_bytes(b"\x00\x0f" * (size // 2),
+                                                  "big")
+    value = (value | value >> 12) & int.from_bytes(b"\x00\x00\x00\xff" *
+                                                   (size // 4), "big")
+    return value.to_bytes(size, "big")[3::4]
+
+
+def _blocks(pattern, seq):
+    starts = array.array("I")
+    sizes = array.array("I")
+    for match in pattern.finditer(seq):
+        starts.append(match.start())
+        sizes.append(match.end() - match.start())
+    return starts, sizes
+
+
+def _record(seq):
+    # The .2bit record of one sequence: its length, N blocks, mask blocks, a
+    # reserved word and the packed bases
+    parts = [struct.pack("<I", len(seq))]
+    for pattern in (N_BLOCKS, MASK_BLOCKS):
+        starts, sizes = _blocks(pattern, seq)
+        parts.append(struct.pack("<I", len(starts)))
+        parts.append(_little_endian(starts))
+        parts.append(_little_endian(sizes))
+    parts.append(struct.pack("<I", 0))
+    parts.append(pack(seq))
+    return b"".join(parts)
+
+
+def _little_endian(values):
+    if sys.byteorder != "little":
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _read_fasta(filename):
+    # Yield the name (header up to the first whitespace) and bases of each
+    # sequence in a fasta file, one sequence in memory at a time
+    name = None
+    data = []
+    with fastq_io.open_input(filename) as infile:
+        for lines in fastq_io.read_lines(infile):
+            for line in lines:
+                if line.startswith(b">"):
+                    if name is not None:
+                        yield name, b"".join(data)
+                    name = line[1:].split(None, 1)[0].decode("utf-8")
+                    data = []
+                elif name is not None:
+                    data.append(line.strip())
+    if name is not None:
+        yield name, b"".join(data)
+
+
+def write_twobit(fasta_filename, twobit_filename):
+    """
+    This function converts a fasta file (optionally gzipped) to a .2bit file.
+    Records are written to a temporary file first, as the index at the start
+    of the file needs their offsets.
+    :params: fasta_filename -- Name of the fasta file to convert.
+
+             twobit_filename -- Name of the .2bit file to write.
+    :return: none
+    """
+    names = []
+    offsets = []
+    directory = os.path.dirname(os.path.abspath(twobit_filename))
+    with tempfile.TemporaryFile(dir=directory) as records:
+        for name, seq in _read_fasta(fasta_filename):
+            names.append(name.encode("utf-8"))
+            offsets.append(records.tell())
+            records.write(_record(seq))
+
+        # Files over 4 GB need version 1, which has 64-bit offsets
+        version = 0
+        header_size = 16 + sum(len(name) + 5 for name in names)
+        if header_size + records.tell() >= 1 << 32:
+            version = 1
+            header_size += 4 * len(names)
+        offset_format = "<Q" if version else "<I"
+
+        records.seek(0)
+        with open(twobit_filename, "wb") as outfile:
+            outfile.write(struct.pack("<4I", SIGNATURE, version, len(names),
+                                      0))
+            for name, offset in zip(names, offsets):
+                outfile.write(bytes([len(name)]) + name +
+                              struct.pack(offset_format, header_size + offset))
+            shutil.copyfileobj(records, outfile)
+
+
+class TwoBitFile:
+    """
+    A memory-mapped .2bit file. fetch() decodes only the packed bytes that
+    hold the requested bases, and the N and mask blocks that overlap them.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, "rb")
+        try:
+            self._data = mmap.mmap(self._file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise TwoBitError(filename + " is empty") from None
+
+        signature = struct.unpack("<I", self._data[:4])[0]
+        if signature == SIGNATURE:
+            self._order = "<"
+        elif signature == struct.unpack(">I", struct.pack("<I", SIGNATURE))[0]:
+            self._order = ">"
+        else:
+            raise TwoBitError(filename + " is not a .2bit file")
+        version, count = self._unpack("2I", 4)
+        offset_size = 8 if version == 1 else 4
+
+        # Index of the file: the offset of the record of each sequence
+        self.index = {}
+        position = 16
+        for _ in range(count):
+            size = self._data[position]
+            name = self._data[position + 1:position + 1 + size].decode("utf-8")
+            position += 1 + size
+            self.index[name] = self._unpack("Q" if version == 1 else "I",
+                                            position)[0]
+            position += offset_size
+        self._records = {}
+
+    def _unpack(self, fmt, offset):
+        fmt = self._order + fmt
+        return struct.unpack_from(fmt, self._data, offset)
+
+    def _array(self, offset, count):
+        values = array.array("I", self._data[offset:offset + 4 * count])
+        if self._order != ("<" if sys.byteorder == "little" else ">"):
+            values.byteswap()
+        return values, offset + 4 * count
+
+    def _record(self, name):
+        # Read and keep the length, N blocks and mask blocks of a sequence
+        if name not in self._records:
+            try:
+                offset = self.index[name]
+            except KeyError:
+                raise TwoBitError("Sequence " + name + " is not in " +
+                                  self.filename) from None
+            length, count = self._unpack("2I", offset)
+            n_starts, offset = self._array(offset + 8, count)
+            n_sizes, offset = self._array(offset, count)
+            count = self._unpack("I", offset)[0]
+            mask_starts, offset = self._array(offset + 4, count)
+            mask_sizes, offset = self._array(offset, count)
+            self._records[name] = (length, (n_starts, n_sizes),
+                                   (mask_starts, mask_sizes), offset + 4)
+        return self._records[name]
+
+    def length(self, name):
+        return self._record(name)[0]
+
+    def fetch(self, name, start, end):
+        """
+        This function returns the bases of a sequence from start up to but not
+        including end, counting from 0. The range is clipped to the length of
+        the sequence.
+        :params: name -- Name of the sequence.
+
+                 start -- Index of the first base.
+
+                 end -- Index one past the last base.
+        :return: A bytes object of the bases.
+        """
+        length, n_blocks, mask_blocks, dna_offset = self._record(name)
+        start = max(start, 0)
+        end = min(end, length)
+        if start >= end:
+            return b""
+
+        packed = self._data[dna_offset + start // 4:dna_offset +
+                            (end + 3) // 4]
+        first = start - start // 4 * 4
+        seq = bytearray(b"".join(map(DECODE.__getitem__, packed))
+                        [first:first + end - start])
+
+        for block_start, block_end in _overlaps(n_blocks, start, end):
+            seq[block_start:block_end] = b"N" * (block_end - block_start)
+        for block_start, block_end in _overlaps(mask_blocks, start, end):
+            seq[block_start:block_end] = seq[block_start:block_end].lower()
+        return bytes(seq)
+
+    def close(self):
+        self._data.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _overlaps(blocks, start, end):
+    # Yield the parts of the blocks that fall within start and end, relative
+    # to start. Blocks are sorted and do not overlap each other.
+    starts, sizes = blocks
+    i = max(bisect.bisect_right(starts, start) - 1, 0)
+    while i < len(starts) and starts[i] < end:
+        block_start = max(starts[i], start)
+        block_end = min(starts[i] + sizes[i], end)
+        if block_start < block_end:
+            yield block_start - start, block_end - start
+        i += 1